@@ -4,12 +4,17 @@
 import streamlit as st
 from streamlit_folium import st_folium
 import pandas as pd
-import joblib
 from datetime import datetime
 from math import ceil
-
-from model import load_models_near, predict
-from mapper import create_empty_map, get_map_info, update_map_info
+from time import sleep
+import os
+import threading
+
+from model import prewarm
+from model import MAX_DIST, BLOCK_MILES # walking distance slider, in city blocks
+from appstate import STATIONS_PERPAGE, PLOT_HEIGHT, PLOT_COL_WIDTH, MODEL_DIR, MODEL_ENGINE
+from appstate import start_search, result, merge_pending, start_fill, merge_fill, labelled_stations
+from mapper import create_empty_map, get_map_info, update_map_info, build_map
 from mapper import STATION_PALETTE, SPACE_NEEDLE
 from plotter import plot_predictions, compute_width, time_to_y
 
@@ -30,11 +35,11 @@ SPACE_NEEDLE = (47.6205, -122.3493)
 MAP_WIDTH=800
 MAP_HEIGHT=800
 
-# Pagination of prediction results
-STATIONS_PERPAGE=8
-PLOT_HEIGHT=9.5 # Not an exact science but should be set proportional to MAP_HEIGHT
-#PLOT_HEIGHT=7.5
-PLOT_COL_WIDTH=0.1 # Approximate width of each col in unit of PLOT_HEIGHT
+# Pagination of prediction results, search settings and the prediction
+# engine are in appstate.py, shared with loadtest.py
+
+# How often to check on results scored in the background, in seconds
+POLL_SECONDS=0.2
 
 # Helper for keeping tabs on the UI cycle, a numbered print if you will
 def counter(pre='', post=''):
@@ -42,14 +47,50 @@ def counter(pre='', post=''):
     st.text('%s%d%s'%(pre, SS.counter, post))
 
 
-model_dir = 'models/' # Pretrained models station-wise
-def run_model(search_params):
-    """ run model according to search parameters """
-    models, stations = load_models_near( location = search_params['location'], within = search_params['dist'] , model_dir = model_dir)
-    if models is None:
-        return None,None
-    predictions = predict(models, stations, date = search_params['date'], return_proba=True)
-    return predictions, stations
+def collect_pending(status):
+    """ merge in predictions of the stations being scored in the
+    background, polling for them in <status>, see
+    appstate.merge_pending
+
+    returns if SS['predictions'] changed
+    """
+    rest = SS.get('pending', None)
+    if rest is None:
+        return False
+    return merge_pending(SS, poll(rest, status, 'Scoring more stations...'))
+
+# st.cache_resource replaced st.experimental_singleton in Streamlit 1.18,
+# which later removed the old name
+cache_resource = getattr(st, 'cache_resource', None) or st.experimental_singleton
+# likewise for st.rerun, which replaced st.experimental_rerun in 1.27
+rerun = getattr(st, 'rerun', None) or st.experimental_rerun
+
+def poll(future, status, message):
+    """Wait for <future>, showing <message> in <status> (an st.empty).
+
+    Updating an element every POLL_SECONDS lets Streamlit stop this run
+    as soon as the user does something else, e.g. changes page. The
+    future is then picked up again by the next run.
+
+    returns the result of <future>, or None if it failed
+    """
+    while not future.done():
+        status.caption(message)
+        sleep(POLL_SECONDS)
+    status.empty()
+    return result(future, message)
+
+@cache_resource
+def start_prewarm():
+    """Pre-warm station catalog, weather and models of MODEL_ENGINE
+    near the Space Needle, once per server process. Runs in the
+    background so that it does not hold up the first paint. Set
+    SEAPARK_PREWARM=0 to skip.
+
+    """
+    t = threading.Thread(target=prewarm, kwargs={'model_dir': MODEL_DIR, 'engine': MODEL_ENGINE}, daemon=True)
+    t.start()
+    return t
 
 
 ################################################################
@@ -77,15 +118,16 @@ def add_datetime_picker():
         options = time_slots,
         index = int(time_to_y('11:00')),
         key = 'time_picker',
+        on_change = enable_go, # stations are ranked around the arrival time
     )
     return UI_DATE, UI_TIME
 
 def add_dist_picker():
     st.subheader('How far are you willing to walk?')
     UI_DIST = st.slider(
-        label = 'An average city block is about 0.07 mi (5 min walk)',
+        label = 'An average city block is about %g mi (5 min walk)'%BLOCK_MILES,
         min_value = 1,
-        max_value = 10,
+        max_value = MAX_DIST,
         value = 1,
         step = 1,
         format = ('%g blocks'),
@@ -130,18 +172,10 @@ def update_stage():
         'location': last_click,
         'date': UI_DATE,
         'time': UI_TIME,
-        'dist': UI_DIST * 0.07, # raw read in city blocks
+        'dist': UI_DIST * BLOCK_MILES, # raw read in city blocks
         #'use_forecast': ui_use_forecast,
     }
-    SS['search_params'] = search_params
-    predictions, stations = run_model(search_params)
-    if stations is not None:
-        # rename stations
-        stations.sourceelementkey = predictions.columns = list(range(1, len(stations)+1))
-    SS['predictions'] = predictions # save predictions even if it's None (i.e., no data or no stations available)
-
-    # Also reset page information
-    SS['page']=1
+    stations = start_search(SS, search_params)
 
     update_map_info(UI_MAP, stations)
     SS.stage = 'pred'
@@ -203,6 +237,9 @@ st.markdown(f"""<h1><a href="https://github.com/z5huang/seapark">Welcome to SeaP
 # Set init stage for first run
 SS.stage = SS.get('stage', 'init')
 
+if os.environ.get('SEAPARK_PREWARM', '1') != '0':
+    start_prewarm()
+
 ################
 # side bar widgets
 with st.sidebar:
@@ -254,12 +291,15 @@ if SS.stage != 'init':
             width = compute_width(PLOT_HEIGHT, PLOT_COL_WIDTH,
                                   nstations, page, STATIONS_PERPAGE)
             
-            st.image(plot_predictions(predictions, (width,PLOT_HEIGHT),
-                                      page, perpage=STATIONS_PERPAGE, hline = UI_TIME),
-                     width=int(width*85),
-                     #use_column_width='auto',
-                     use_column_width='never'
-                     )
+            plot_area = st.empty()
+            def show_predictions(predictions):
+                plot_area.image(plot_predictions(predictions, (width,PLOT_HEIGHT),
+                                                 page, perpage=STATIONS_PERPAGE, hline = UI_TIME),
+                                width=int(width*85),
+                                #use_column_width='auto',
+                                use_column_width='never'
+                                )
+            show_predictions(predictions)
             pmax = ceil(nstations / STATIONS_PERPAGE)
             if page < pmax:
                 with cs3:
@@ -267,6 +307,25 @@ if SS.stage != 'init':
             if page > 1:
                 with cs2:
                     st.button(label='<<', on_click = prev_page)
+            # Only the first page has been scored at search, and the
+            # others are being scored in the background. Wait for them
+            # now that the first results and the page buttons are on
+            # screen
+            if collect_pending(st.empty()):
+                if SS['predictions'] is None or len(SS['predictions'].columns) != nstations:
+                    # stations whose model failed to load were dropped.
+                    # Take them off the map, and redraw the results
+                    _, map_bounds = get_map_info(UI_MAP)
+                    SS['new_map'] = build_map(SS['search_params']['location'], map_bounds, labelled_stations(SS))
+                    rerun()
+                predictions = SS['predictions']
+                show_predictions(predictions)
+            # Fill in the rest of the day, see appstate.SCORE_WINDOW
+            start_fill(SS)
+            if SS.get('filling', None) is not None:
+                if merge_fill(SS, poll(SS['filling'], st.empty(), 'Scoring the rest of the day...')):
+                    predictions = SS['predictions']
+                    show_predictions(predictions)
 
 
 
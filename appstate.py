@@ -0,0 +1,158 @@
+# State of the app's search results, shared by app.py and loadtest.py
+#
+# A search goes through the same steps in the app and in the load
+# test: run_model, then the stations being scored in the background are
+# merged in (merge_pending), and the rest of the day is filled in
+# (start_fill, merge_fill). The functions here keep their state in a
+# mapping, st.session_state in the app, a dict in the load test. What
+# is on screen, and how long to wait for the background jobs, is up to
+# the caller.
+import os
+import sys
+from math import ceil
+
+from model import run_search, fill_predictions_later, rank_results
+
+# Pagination of prediction results
+STATIONS_PERPAGE=8
+PLOT_HEIGHT=9.5 # Not an exact science but should be set proportional to app.MAP_HEIGHT
+#PLOT_HEIGHT=7.5
+PLOT_COL_WIDTH=0.1 # Approximate width of each col in unit of PLOT_HEIGHT
+
+# Score only +/- SCORE_WINDOW minutes around the arrival time at
+# search, and fill in the rest of the day in the background after the
+# first paint. Off by default: a model's cost per call is mostly
+# fixed, e.g. 8 models of the shipped shape took 218 ms on the 13
+# slots of a 30 min window and 479 ms on all 120, but 597 ms with the
+# fill. The first paint gains less than the total inference loses
+SCORE_WINDOW=None
+
+# Rank stations by their mean availability within +/- RANK_WINDOW
+# minutes of the arrival time
+RANK_WINDOW=30
+
+# Score the first page of nearest stations at search, and the other
+# pages in the background. The first page is ranked on its own, and
+# all stations again once the others are in
+PROGRESSIVE=True
+
+MODEL_DIR = 'models/' # Pretrained models station-wise
+# Prediction engine, see model.ENGINES. 'auto' falls back to empirical
+# tables for stations without a pretrained model; 'empirical' is the
+# cheap option when the server is under load
+MODEL_ENGINE = os.environ.get('SEAPARK_ENGINE', 'auto')
+
+def run_model(search_params, engine=MODEL_ENGINE, model_dir=MODEL_DIR):
+    """ run model according to search parameters
+
+    returns (predictions, stations, models, rest). With SCORE_WINDOW,
+    predictions outside of the window are left as NaN. With
+    PROGRESSIVE, only the first page of stations is scored, and <rest>
+    is a Future of (predictions, models) for the others, see
+    model.search_progressive. Otherwise <rest> is None. Stations are
+    ranked by availability around the arrival time if RANK_WINDOW
+
+    Results at a destination are reused for any smaller walking
+    distance, and after the first search the full day at the largest
+    distance is computed in the background, see model.run_search
+    """
+    return run_search(search_params['location'], search_params['dist'], search_params['date'],
+                      time = search_params['time'], window = SCORE_WINDOW, progressive = PROGRESSIVE,
+                      first = STATIONS_PERPAGE, engine = engine, model_dir = model_dir,
+                      rank_window = RANK_WINDOW)
+
+def start_search(state, search_params, engine=MODEL_ENGINE, model_dir=MODEL_DIR):
+    """ run_model and keep its results in <state>, with stations
+    renamed 1, 2, ... in the order listed
+
+    returns the renamed stations, for the map, or None
+    """
+    state['search_params'] = search_params
+    predictions, stations, models, rest = run_model(search_params, engine, model_dir)
+    # keep models, original station ids and the stations still being
+    # scored around for filling in the rest later
+    state['models'] = models
+    state['pending'] = rest
+    state['model_stations'] = None if stations is None else stations.copy()
+    state['filling'] = None # Future of the rest of the day, see SCORE_WINDOW
+    state['filled'] = SCORE_WINDOW is None
+    if stations is not None:
+        # rename stations
+        predictions.columns = list(range(1, len(stations)+1))
+    state['predictions'] = predictions # save predictions even if it's None (i.e., no data or no stations available)
+
+    # Also reset page information
+    state['page'] = 1
+    return labelled_stations(state)
+
+def labelled_stations(state):
+    """ state['model_stations'] with the labels of state['predictions']
+    as station ids, as shown on the map, or None """
+    if state['model_stations'] is None:
+        return None
+    stations = state['model_stations'].copy()
+    stations.sourceelementkey = list(state['predictions'].columns)
+    return stations
+
+def result(future, what):
+    """ result of <future>, waiting for it if needed, or None if it
+    failed """
+    try:
+        return future.result()
+    except Exception as e:
+        print(f'{what} failed: {e!r}', file=sys.stderr)
+        return None
+
+def merge_pending(state, res):
+    """ merge in <res>, the result of state['pending'] (None if it
+    failed, in which case those stations are left blank), and rank all
+    stations again. Stations whose model failed to load are dropped,
+    the others keep their labels
+
+    returns if state['predictions'] changed
+    """
+    state['pending'] = None
+    if res is None:
+        return False
+    rest_predictions, rest_models = res
+
+    # columns of state['predictions'] have been renamed, so match by position
+    predictions = state['predictions'].copy()
+    ids = list(state['model_stations'].sourceelementkey)
+    cols = [ ids.index(sid) for sid in rest_predictions.columns ]
+    predictions.iloc[:, cols] = rest_predictions.values
+    state['models'] = models = {**state['models'], **rest_models}
+    stations = state['model_stations']
+    loaded = stations.sourceelementkey.isin(models).values
+    predictions, stations = predictions.loc[:, loaded], stations[loaded].reset_index(drop=True)
+    if len(stations) == 0: # none loaded after all
+        state['predictions'] = state['model_stations'] = None
+        return True
+    if RANK_WINDOW:
+        # columns keep their labels, so that they match the map markers
+        predictions, stations = rank_results(predictions, stations, state['search_params']['time'], RANK_WINDOW)
+    state['predictions'], state['model_stations'] = predictions, stations
+    state['page'] = min(state['page'], ceil(len(stations) / STATIONS_PERPAGE))
+    return True
+
+def start_fill(state):
+    """ with SCORE_WINDOW, only the window around the arrival time has
+    been scored at search. Fill in the rest of the day in the
+    background, once the other stations are merged in. Sets
+    state['filling'] to its Future, if there is anything to do """
+    if state['filled'] or state.get('filling', None) is not None or state.get('pending', None) is not None:
+        return
+    state['filling'] = fill_predictions_later(state['models'], state['model_stations'], state['predictions'],
+                                              state['search_params']['date'], return_proba=True)
+
+def merge_fill(state, filled):
+    """ keep <filled>, the result of state['filling'] (None if it
+    failed)
+
+    returns if state['predictions'] changed
+    """
+    state['filling'], state['filled'] = None, True
+    if filled is None or filled is state['predictions']:
+        return False
+    state['predictions'] = filled
+    return True
@@ -0,0 +1,207 @@
+# Backtest station models against held-out history
+#
+# Usage:
+#   python backtest.py --dir data/station_data --years 2018 --jobs 8 --out backtest.csv
+#   python backtest.py --engine empirical --years 2018 11133 11134
+#
+# For every station (default: all in the model directory), held-out
+# days are read, resampled and merged with weather the same way as for
+# training, restricted to the time slots the app shows, and scored in
+# large batches. Stations are spread over worker processes.
+#
+# A slot counts as available if paidoccupancy < parkingspacecount.
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+import seattle_parking as sp
+
+# Input columns of the pre-trained models, in case a model does not
+# record them itself
+FEATURES = ['occupancydatetime', 'paidoccupancy', 'parkingspacecount', 'TMAX', 'TMIN', 'PRCP', 'SNOW', 'SNWD']
+
+# Time slots shown in the app: 8:00 to 17:55
+SLOT_HOURS = (8, 18)
+
+# Bins of predicted probability for calibration
+NBINS = 10
+
+BATCH = 200000 # rows per predict_proba call
+
+def model_path(station, engine, model_dir, empirical_dir):
+    if engine == 'empirical':
+        return os.path.join(empirical_dir, f'{station}.npz')
+    return os.path.join(model_dir, f'{station}.joblib')
+
+def load_model(station, engine='model', model_dir='models/', empirical_dir='empirical/'):
+    """ load the model of <station>, or print the error and return None
+    if it fails. Not through model.py's cache: each model is used once
+    here, and the cache would only keep it in memory """
+    path = model_path(station, engine, model_dir, empirical_dir)
+    try:
+        if engine == 'empirical':
+            from empirical import EmpiricalTable
+            return EmpiricalTable.load(path)
+        import joblib
+        return joblib.load(path)
+    except Exception as e:
+        print(f'Failed to load {path}: {e!r}', file=sys.stderr)
+        return None
+
+def list_models(engine='model', model_dir='models/', empirical_dir='empirical/'):
+    """ stations with a model of <engine> """
+    d, ext = (empirical_dir, '.npz') if engine == 'empirical' else (model_dir, '.joblib')
+    return sorted( int(f[:-len(ext)]) for f in os.listdir(d) if f.endswith(ext) and f[:-len(ext)].isdigit() )
+
+def prepare_data(station, years, dir, weather):
+    """ held-out data of <station>, resampled and merged with weather,
+    within the app's time slots. Returns None if no data """
+    df = sp.read_parking_data_multiyear(station, years, dir, compact=True)
+    if df is None:
+        return None
+    df = sp.resample_parking_data(df, compact=True)
+    hr = df.occupancydatetime.dt.hour
+    df = df[(hr >= SLOT_HOURS[0]) & (hr < SLOT_HOURS[1])]
+    return sp.merge_station_weather(df, weather).reset_index(drop=True)
+
+def score_batches(m, X, batch=BATCH):
+    """ probability of availability for rows of X, <batch> rows at a time """
+    return np.concatenate([ m.predict_proba(X.iloc[i:i+batch])[:,1] for i in range(0, len(X), batch) ])
+
+def metrics(p, y):
+    """ accuracy, Brier score and log loss of probabilities <p> of
+    availability against the observed <y> """
+    p_clip = np.clip(p, 1e-6, 1-1e-6)
+    return {
+        'accuracy': ((p > 0.5) == y).mean(),
+        'brier': ((p - y)**2).mean(),
+        'log_loss': -(y*np.log(p_clip) + (1-y)*np.log(1-p_clip)).mean(),
+    }
+
+def calibration_counts(p, y, nbins=NBINS):
+    """ per bin of predicted probability: number of rows, sum of p, and
+    number of rows available. Sums (rather than means) so that they
+    can be added up across stations """
+    b = np.minimum((p * nbins).astype(int), nbins-1)
+    return (np.bincount(b, minlength=nbins),
+            np.bincount(b, weights=p, minlength=nbins),
+            np.bincount(b, weights=y, minlength=nbins))
+
+def backtest_station(station, years, dir, weather, engine='model', model_dir='models/', empirical_dir='empirical/', batch=BATCH):
+    """ backtest a single station
+
+    returns dict of metrics, with per bin calibration counts under
+    'calibration', or None if the station has no data or its model
+    fails to load
+    """
+    df = prepare_data(station, years, dir, weather)
+    if df is None or len(df) == 0:
+        return None
+    m = load_model(station, engine, model_dir, empirical_dir)
+    if m is None:
+        return None
+
+    cols = list(getattr(m, 'feature_names_in_', FEATURES))
+    y = (df.paidoccupancy.values < df.parkingspacecount.values)
+
+    t0 = perf_counter()
+    p = score_batches(m, df[cols], batch)
+    seconds = perf_counter() - t0
+
+    return {
+        'station': station,
+        'rows': len(df),
+        'base_rate': y.mean(),
+        **metrics(p, y),
+        'seconds': seconds,
+        'rows_per_sec': len(df) / seconds if seconds > 0 else np.nan,
+        'calibration': calibration_counts(p, y),
+    }
+
+def aggregate(results, wall_seconds):
+    """ combine per station results into overall metrics and a
+    calibration table """
+    df = pd.DataFrame([ {k:v for k,v in r.items() if k != 'calibration'} for r in results ])
+    w = df.rows / df.rows.sum()
+    overall = {
+        'stations': len(df),
+        'rows': int(df.rows.sum()),
+        'base_rate': (df.base_rate * w).sum(),
+        'accuracy': (df.accuracy * w).sum(),
+        'brier': (df.brier * w).sum(),
+        'log_loss': (df.log_loss * w).sum(),
+        # scoring only, per worker
+        'scoring_rows_per_sec': df.rows.sum() / df.seconds.sum(),
+        # including reading data and loading models, all workers
+        'end_to_end_rows_per_sec': df.rows.sum() / wall_seconds,
+    }
+
+    n, psum, ysum = ( np.sum([ r['calibration'][i] for r in results ], axis=0) for i in range(3) )
+    with np.errstate(invalid='ignore', divide='ignore'):
+        calib = pd.DataFrame({
+            'bin': [ f'{i/NBINS:.1f}-{(i+1)/NBINS:.1f}' for i in range(NBINS) ],
+            'rows': n.astype(int),
+            'mean_predicted': psum / n,
+            'observed': ysum / n,
+        }).set_index('bin')
+    # expected calibration error: |predicted - observed|, weighted by rows
+    overall['ece'] = np.nansum(abs(calib.mean_predicted - calib.observed) * calib.rows) / n.sum()
+    return df, overall, calib
+
+def backtest(stations, years, dir, jobs=os.cpu_count(), engine='model', model_dir='models/', empirical_dir='empirical/',
+             weather_fn='data/seattle_weather.csv.gz', batch=BATCH):
+    """ backtest <stations> over held-out <years> with <jobs> processes
+
+    returns (per station dataframe, dict of overall metrics, calibration dataframe)
+    """
+    weather = sp.read_noaa_weather_data(weather_fn)
+    kwargs = dict(engine=engine, model_dir=model_dir, empirical_dir=empirical_dir, batch=batch)
+
+    t0 = perf_counter()
+    results = []
+    if jobs <= 1:
+        results = [ backtest_station(s, years, dir, weather, **kwargs) for s in stations ]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = { pool.submit(backtest_station, s, years, dir, weather, **kwargs): s for s in stations }
+            for f in as_completed(futures):
+                try:
+                    results.append(f.result())
+                except Exception as e:
+                    print(f'Station {futures[f]} failed: {e!r}', file=sys.stderr)
+    results = [ r for r in results if r is not None ]
+    if not results:
+        return None, None, None
+    return aggregate(results, perf_counter() - t0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backtest station models against held-out history')
+    parser.add_argument('stations', nargs='*', type=int, help='stations to backtest, default all with a model')
+    parser.add_argument('--dir', default='data/station_data', help='base directory of station data')
+    parser.add_argument('--years', required=True, help='held-out years, e.g. 2018 or 2018-2019')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--engine', choices=['model', 'empirical'], default='model')
+    parser.add_argument('--model-dir', default='models/')
+    parser.add_argument('--empirical-dir', default='empirical/')
+    parser.add_argument('--batch', type=int, default=BATCH, help='rows per predict_proba call')
+    parser.add_argument('--out', help='write per station metrics to this csv')
+    args = parser.parse_args()
+
+    stations = args.stations or list_models(args.engine, args.model_dir, args.empirical_dir)
+    per_station, overall, calib = backtest(stations, sp.parse_years(args.years), args.dir, args.jobs,
+                                           args.engine, args.model_dir, args.empirical_dir, batch=args.batch)
+    if per_station is None:
+        sys.exit('No station could be backtested')
+    if args.out:
+        per_station.to_csv(args.out, index=False)
+    print(per_station.sort_values('accuracy').to_string(index=False, float_format='%.3f'))
+    print()
+    print(calib.to_string(float_format='%.3f'))
+    print()
+    for k, v in overall.items():
+        print('%-24s %s'%(k, '%.4g'%v if isinstance(v, float) else v))
@@ -0,0 +1,128 @@
+# Compare the global model against the per-station models
+#
+# Usage:
+#   python compare_models.py --dir data/station_data --years 2018
+#   python compare_models.py --skip-accuracy --radius 0.3 0.7
+#
+# Accuracy: held-out data of each station (prepared as in backtest.py)
+# is scored by its own model and by the global model.
+#
+# Latency: the stations with a per-station model within a few radii of
+# a few destinations are loaded and scored by their own models and by
+# the global model, cold (nothing loaded) and warm (models loaded).
+# Both engines score the same stations, so only destinations within
+# the coverage of models/ are meaningful.
+import argparse
+import datetime
+import os
+import sys
+from time import perf_counter
+
+import pandas as pd
+
+import seattle_parking as sp
+import model
+import backtest
+import global_model
+
+# Destinations for the latency test, within the coverage of the
+# shipped models: the Space Needle, Climate Pledge Arena, Seattle
+# Center by Denny Way, Lower Queen Anne and the north of Belltown
+DESTINATIONS = [sp.SPACE_NEEDLE, (47.6221, -122.3540), (47.6180, -122.3480), (47.6240, -122.3560), (47.6160, -122.3440)]
+RADII = [0.3, 0.7]
+
+def compare_station(station, years, dir, weather, catalog, gm, model_dir='models/', batch=backtest.BATCH):
+    """ metrics of the per-station model and of the global model <gm>
+    on held-out data of <station>, or None if either is unavailable """
+    desc = catalog[catalog.sourceelementkey == station]
+    df = backtest.prepare_data(station, years, dir, weather)
+    if df is None or len(df) == 0 or len(desc) == 0:
+        return None
+    m = backtest.load_model(station, 'model', model_dir)
+    if m is None:
+        return None
+    for c in global_model.DESCRIPTORS:
+        df[c] = desc[c].values[0]
+    y = (df.paidoccupancy.values < df.parkingspacecount.values)
+
+    res = {'station': station, 'rows': len(df), 'base_rate': y.mean()}
+    for name, mm, cols in [('station', m, list(getattr(m, 'feature_names_in_', backtest.FEATURES))),
+                           ('global', gm, global_model.FEATURES)]:
+        t0 = perf_counter()
+        p = backtest.score_batches(mm, df[cols], batch)
+        res[f'{name}_seconds'] = perf_counter() - t0
+        res.update({ f'{name}_{k}': v for k, v in backtest.metrics(p, y).items() })
+    return res
+
+def compare_accuracy(stations, years, dir, gm, model_dir='models/', weather_fn='data/seattle_weather.csv.gz'):
+    """ per station dataframe of compare_station, and the row weighted
+    overall metrics """
+    weather = sp.read_noaa_weather_data(weather_fn)
+    catalog = sp.read_station_catalog()
+    results = [ compare_station(s, years, dir, weather, catalog, gm, model_dir) for s in stations ]
+    df = pd.DataFrame([ r for r in results if r is not None ])
+    if len(df) == 0:
+        return None, None
+    w = df.rows / df.rows.sum()
+    overall = { c: (df[c] * w).sum() for c in df.columns if c not in ('station', 'rows', 'base_rate') and not c.endswith('_seconds') }
+    for name in ('station', 'global'):
+        overall[f'{name}_rows_per_sec'] = df.rows.sum() / df[f'{name}_seconds'].sum()
+    return df, overall
+
+def time_searches(destinations=DESTINATIONS, radii=RADII, date=datetime.date(2018, 6, 1), model_dir='models/'):
+    """ seconds to load and score the stations with a per-station model
+    around each destination, by engine, as rows of (engine, radius,
+    destination, stations, cold, warm). Both engines score the same
+    stations. Cold runs start with no model loaded, warm ones reuse
+    the loaded models. Destinations without any such station are
+    skipped """
+    rows = []
+    for within in radii:
+        for loc in destinations:
+            stations = model.find_model_stations(loc, within, model_dir=model_dir, engine='model')
+            if stations is None:
+                print(f'No station with a model within {within} mi of {loc}', file=sys.stderr)
+                continue
+            for engine in ('model', 'global'):
+                if engine == 'global':
+                    stations = stations.assign(engine='global',
+                                               model_path=os.path.join(model_dir, global_model.GLOBAL_MODEL_FN))
+                t = {}
+                for run in ('cold', 'warm'):
+                    if run == 'cold':
+                        model.clear_caches()
+                    t0 = perf_counter()
+                    models = dict(model.iter_models(stations))
+                    model.predict(models, stations, date, return_proba=True)
+                    t[run] = perf_counter() - t0
+                rows.append({'engine': engine, 'radius': within, 'destination': loc,
+                             'stations': len(models), **t})
+    model.clear_caches()
+    return pd.DataFrame(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the global model against the per-station models')
+    parser.add_argument('stations', nargs='*', type=int, help='stations for the accuracy test, default all with a model')
+    parser.add_argument('--dir', default='data/station_data', help='base directory of station data')
+    parser.add_argument('--years', default='2018', help='held-out years, e.g. 2018 or 2018-2019')
+    parser.add_argument('--model-dir', default='models/')
+    parser.add_argument('--radius', type=float, nargs='+', default=RADII, help='search radii for the latency test, in miles')
+    parser.add_argument('--skip-accuracy', action='store_true')
+    parser.add_argument('--skip-latency', action='store_true')
+    args = parser.parse_args()
+
+    if not args.skip_accuracy:
+        gm = model.load_model(os.path.join(args.model_dir, global_model.GLOBAL_MODEL_FN))
+        stations = args.stations or backtest.list_models('model', args.model_dir)
+        per_station, overall = compare_accuracy(stations, sp.parse_years(args.years), args.dir, gm, args.model_dir)
+        if per_station is None:
+            sys.exit('No station could be compared')
+        print(per_station.to_string(index=False, float_format='%.3f'))
+        print()
+        for k, v in overall.items():
+            print('%-24s %.4g'%(k, v))
+        print()
+
+    if not args.skip_latency:
+        df = time_searches(radii=args.radius, model_dir=args.model_dir)
+        print(df.groupby(['engine', 'radius'])[['stations', 'cold', 'warm']].mean().to_string(float_format='%.4f'))
@@ -0,0 +1,198 @@
+# Model-free prediction from historical availability frequencies
+#
+# For each station, count how often a spot was open in the resampled
+# history, indexed by (day-of-week, day-of-year bucket, 5min slot,
+# weather bucket). Predictions are then array lookups, which makes
+# this a cheap stand-in for stations without a trained model, or for
+# when the server is under load.
+#
+# Build tables with e.g.
+#   python empirical.py --dir data/station_data --years 2012-2017 --weather
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import seattle_parking as sp
+
+# Time slots covered, same as model.time_slots: 8:00 to 17:55 every 5 min
+SLOT_START = 8*60 # minutes since midnight
+SLOT_MINUTES = 5
+NSLOTS = 120
+
+DOY_BUCKET = 14 # days per day-of-year bucket
+PRCP_WET = 1.0 # daily precipitation above which a day is counted as wet, in data units
+
+class EmpiricalTable:
+    """Availability frequencies of one station, in a dense array
+    freq[dow, doy_bucket, slot, weather_bucket].
+
+    Mimics the predict/predict_proba interface of the pickled models,
+    so it can be scored by model.predict alongside them. model.score
+    uses predict_proba_climatology, since it imputes the weather.
+
+    """
+    def __init__(self, freq, total=None, doy_bucket=DOY_BUCKET, prcp_wet=PRCP_WET):
+        """
+        freq: frequency of availability, float array of shape
+        (7, ndoy_buckets, NSLOTS, nweather), nweather being 2 if
+        built with weather, 1 otherwise
+
+        total: number of records behind each entry of freq, for reference
+        """
+        self.freq = freq
+        self.total = total
+        self.doy_bucket = doy_bucket
+        self.prcp_wet = prcp_wet
+
+    @property
+    def use_weather(self):
+        return self.freq.shape[-1] > 1
+
+    def index(self, X):
+        """ indices into freq for rows of X. X needs a column
+        'occupancydatetime' and, if built with weather, 'PRCP'. Times
+        outside of the covered slots are clipped to the nearest slot """
+        t = pd.to_datetime(X['occupancydatetime'])
+        dow = t.dt.day_of_week.values
+        doy = (t.dt.day_of_year.values - 1) // self.doy_bucket
+        slot = ((t.dt.hour.values*60 + t.dt.minute.values - SLOT_START) // SLOT_MINUTES).clip(0, NSLOTS-1)
+        if self.use_weather:
+            wb = (np.asarray(X['PRCP'], dtype=float) > self.prcp_wet).astype(int)
+        else:
+            wb = np.zeros(len(t), dtype=int)
+        return dow, doy, slot, wb
+
+    def predict_proba(self, X):
+        p = self.freq[self.index(X)].astype(np.float64)
+        return np.stack([1-p, p], axis=1)
+
+    def predict(self, X):
+        return self.freq[self.index(X)] > 0.5
+
+    def wet_rate(self):
+        """ fraction of records on wet days, per doy bucket, as counted
+        in <total>. Buckets without records get the overall rate """
+        n = self.total.sum(axis=(0,2)) # (ndoy_buckets, nweather)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rate = n[:,1] / n.sum(axis=1)
+        rate[np.isnan(rate)] = n[:,1].sum() / max(n.sum(), 1)
+        return rate
+
+    def predict_proba_climatology(self, X):
+        """Like predict_proba, for X whose weather is imputed from
+        climatology, as by model.impute_weather. A mean PRCP says little
+        about whether the day will be wet (it is above PRCP_WET on most
+        days of the year), so the dry and wet frequencies are mixed by
+        the historical rate of wet days instead.
+        """
+        if not self.use_weather or self.total is None:
+            return self.predict_proba(X)
+        dow, doy, slot, _ = self.index(X)
+        r = self.wet_rate()[doy]
+        p = ((1-r) * self.freq[dow, doy, slot, 0] + r * self.freq[dow, doy, slot, 1]).astype(np.float64)
+        return np.stack([1-p, p], axis=1)
+
+    def save(self, fn):
+        np.savez_compressed(fn, freq=self.freq, total=self.total,
+                            doy_bucket=self.doy_bucket, prcp_wet=self.prcp_wet)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as f:
+            return cls(f['freq'], f['total'], int(f['doy_bucket']), float(f['prcp_wet']))
+
+def _backoff(hits, total):
+    """ hits/total, with empty entries filled in from coarser and
+    coarser marginals: first over doy buckets, then weather, then
+    day-of-week, and finally the overall mean of the station """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        freq = hits / total
+        for axes in [(1,), (1,3), (0,1,3), (0,1,2,3)]:
+            missing = np.isnan(freq)
+            if not missing.any():
+                break
+            h = hits.sum(axis=axes, keepdims=True)
+            n = total.sum(axis=axes, keepdims=True)
+            coarse = np.broadcast_to(h / n, freq.shape)
+            freq[missing] = coarse[missing]
+    return freq
+
+def build_table(df, use_weather=False, doy_bucket=DOY_BUCKET, prcp_wet=PRCP_WET):
+    """Build an EmpiricalTable from resampled station data.
+
+    df: as returned by sp.resample_parking_data, merged with weather
+    (sp.merge_station_weather) if <use_weather>
+
+    A slot counts as available if paidoccupancy < parkingspacecount
+    """
+    t = df.occupancydatetime
+    minutes = t.dt.hour.values*60 + t.dt.minute.values - SLOT_START
+    sel = (minutes >= 0) & (minutes < NSLOTS * SLOT_MINUTES)
+    df, t, minutes = df[sel], t[sel], minutes[sel]
+
+    nweather = 2 if use_weather else 1
+    shape = (7, (366 - 1) // doy_bucket + 1, NSLOTS, nweather)
+    dow = t.dt.day_of_week.values
+    doy = (t.dt.day_of_year.values - 1) // doy_bucket
+    slot = minutes // SLOT_MINUTES
+    if use_weather:
+        wb = (df.PRCP.values > prcp_wet).astype(int)
+    else:
+        wb = np.zeros(len(df), dtype=int)
+
+    avail = (df.paidoccupancy.values < df.parkingspacecount.values)
+    idx = np.ravel_multi_index((dow, doy, slot, wb), shape)
+    size = np.prod(shape)
+    total = np.bincount(idx, minlength=size).reshape(shape)
+    hits = np.bincount(idx, weights=avail, minlength=size).reshape(shape)
+
+    freq = _backoff(hits, total).astype(np.float32)
+    return EmpiricalTable(freq, total.astype(np.int32), doy_bucket, prcp_wet)
+
+def build_tables(stations, years, dir, out_dir='empirical/', use_weather=False,
+                 weather_fn='data/seattle_weather.csv.gz', doy_bucket=DOY_BUCKET):
+    """ build and save tables for <stations> from raw data under <dir>,
+    see sp.read_parking_data_multiyear. Tables are saved as
+    <out_dir>/<station>.npz
+
+    returns list of stations built
+    """
+    weather = sp.read_noaa_weather_data(weather_fn) if use_weather else None
+    os.makedirs(out_dir, exist_ok=True)
+
+    done = []
+    for station in stations:
+        df = sp.read_parking_data_multiyear(station, years, dir, compact=True)
+        if df is None:
+            continue
+        df = sp.resample_parking_data(df, compact=True)
+        if use_weather:
+            df = sp.merge_station_weather(df, weather)
+        build_table(df, use_weather, doy_bucket).save(os.path.join(out_dir, f'{station}.npz'))
+        done.append(station)
+        print(f'Built {station}', file=sys.stderr)
+    return done
+
+def list_stations(dir):
+    """ all stations with data in any year under <dir> """
+    res = set()
+    for year in os.listdir(dir):
+        ydir = os.path.join(dir, year)
+        if os.path.isdir(ydir):
+            res.update(int(f.split('.')[0]) for f in os.listdir(ydir) if f.endswith('.csv.gz'))
+    return sorted(res)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build empirical availability tables')
+    parser.add_argument('stations', nargs='*', type=int, help='stations to build, default all found in --dir')
+    parser.add_argument('--dir', default='data/station_data', help='base directory of station data')
+    parser.add_argument('--years', default='2012-2017', help='e.g. 2012-2017 or 2012,2014')
+    parser.add_argument('--out', default='empirical/', help='output directory')
+    parser.add_argument('--weather', action='store_true', help='also bucket by dry/wet day')
+    parser.add_argument('--doy-bucket', type=int, default=DOY_BUCKET, help='days per day-of-year bucket')
+    args = parser.parse_args()
+    build_tables(args.stations or list_stations(args.dir), sp.parse_years(args.years), args.dir,
+                 args.out, args.weather, doy_bucket=args.doy_bucket)
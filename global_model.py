@@ -0,0 +1,148 @@
+# A single model for all stations
+#
+# Instead of one pipeline per station, train one classifier over all
+# stations, using the same time features as the per-station models
+# (TimeSplitter, TrigTransformer) plus weather, space count and station
+# descriptors (location, time limits). A radius query is then one
+# predict_proba call over a (time slots x stations) feature matrix.
+#
+# Train with e.g.
+#   python global_model.py --dir data/station_data --years 2012-2017 --sample 0.2
+# which saves models/global.joblib, used by the app with SEAPARK_ENGINE=global
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+import seattle_parking as sp
+
+GLOBAL_MODEL_FN = 'global.joblib' # in the model directory
+
+# Station descriptors, as columns of the station catalog. Its
+# space_count is the parkingspacecount feature
+DESCRIPTORS = ['latitude', 'longitude', 'time_limit_min', 'time_limit_max']
+WEATHER = ['TMAX', 'TMIN', 'PRCP', 'SNOW', 'SNWD']
+FEATURES = ['occupancydatetime', 'parkingspacecount'] + WEATHER + DESCRIPTORS
+
+# Same as the default of TrigTransformer
+TRIG_PLAN = {
+    'doy': (365.25, [1,2]),
+    'dow': (5, [1,2]), # only work days, so period = 5
+    'hr': (10, [1,2]), # only 8 am to 17:55 pm
+    'min': (60, [1,2]),
+}
+
+class GlobalModel:
+    """A fitted pipeline over FEATURES, shared by all stations.
+
+    model.score() recognizes it by predict_proba_stations, and scores
+    all stations that share it in one call.
+    """
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def features(self, X, stations):
+        """ feature matrix for every row of X (time slots, with weather)
+        at every station in <stations>, station major """
+        n = len(X)
+        res = pd.DataFrame({
+            'occupancydatetime': np.tile(np.asarray(X['occupancydatetime']), len(stations)),
+            'parkingspacecount': np.repeat(stations.space_count.values, n),
+        })
+        for c in WEATHER:
+            res[c] = np.tile(np.asarray(X[c]), len(stations))
+        for c in DESCRIPTORS:
+            res[c] = np.repeat(stations[c].values, n)
+        return res
+
+    def predict_proba_stations(self, X, stations):
+        """ probability of availability, as an array of shape (len(X), len(stations)) """
+        p = self.pipeline.predict_proba(self.features(X, stations))[:,1]
+        return p.reshape(len(stations), len(X)).T
+
+    # Also usable as a single station model, given X with descriptors
+    def predict_proba(self, X):
+        return self.pipeline.predict_proba(X[FEATURES])
+
+    def predict(self, X):
+        return self.pipeline.predict(X[FEATURES])
+
+def make_pipeline(max_iter=300, random_state=0):
+    """ time features as for the per-station models, everything else
+    passed through to a gradient boosting classifier, which copes with
+    millions of rows and with missing weather """
+    from sklearn.compose import ColumnTransformer
+    from sklearn.pipeline import Pipeline
+    from sklearn.ensemble import HistGradientBoostingClassifier
+    from learning import TimeSplitter, TrigTransformer
+
+    time_features = Pipeline([
+        ('split', TimeSplitter()),
+        ('trig', TrigTransformer(plan=TRIG_PLAN)),
+    ])
+    ct = ColumnTransformer([('tstrig', time_features, 'occupancydatetime')], remainder='passthrough')
+    return Pipeline([
+        ('ct', ct),
+        ('clf', HistGradientBoostingClassifier(max_iter=max_iter, random_state=random_state)),
+    ])
+
+def station_data(station, years, dir, weather, catalog):
+    """ data of <station> as prepared by backtest.prepare_data, with
+    station descriptors. None if no data or the station is not in
+    <catalog> """
+    import backtest # imports model, which imports this module
+
+    desc = catalog[catalog.sourceelementkey == station]
+    if len(desc) == 0:
+        return None
+    df = backtest.prepare_data(station, years, dir, weather)
+    if df is None:
+        return None
+    for c in DESCRIPTORS:
+        df[c] = desc[c].values[0]
+    return df
+
+def training_data(stations, years, dir, weather, catalog, sample=None, random_state=0):
+    """ (X, y) over all <stations>, optionally keeping a fraction
+    <sample> of each station's rows. A slot counts as available if
+    paidoccupancy < parkingspacecount """
+    frames = []
+    for station in stations:
+        df = station_data(station, years, dir, weather, catalog)
+        if df is None:
+            continue
+        if sample:
+            df = df.sample(frac=sample, random_state=random_state)
+        frames.append(df)
+    df = pd.concat(frames, ignore_index=True)
+    return df[FEATURES], (df.paidoccupancy < df.parkingspacecount).values
+
+def train(stations, years, dir, weather_fn='data/seattle_weather.csv.gz', catalog=None, sample=None, **kwargs):
+    """ train a GlobalModel on <stations>; kwargs go to make_pipeline """
+    weather = sp.read_noaa_weather_data(weather_fn)
+    if catalog is None:
+        catalog = sp.read_station_catalog()
+    X, y = training_data(stations, years, dir, weather, catalog, sample)
+    print(f'Training on {len(X)} rows', file=sys.stderr)
+    return GlobalModel(make_pipeline(**kwargs).fit(X, y))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train a single model for all stations')
+    parser.add_argument('stations', nargs='*', type=int, help='stations to train on, default all with a per-station model')
+    parser.add_argument('--dir', default='data/station_data', help='base directory of station data')
+    parser.add_argument('--years', default='2012-2017', help='e.g. 2012-2017 or 2012,2014')
+    parser.add_argument('--sample', type=float, help='fraction of rows to keep per station')
+    parser.add_argument('--max-iter', type=int, default=300, help='boosting iterations')
+    parser.add_argument('--model-dir', default='models/')
+    args = parser.parse_args()
+
+    import joblib
+    import backtest
+    import global_model # so that the model is pickled as global_model.GlobalModel, not __main__'s
+    # by default, the stations with a per-station model
+    stations = args.stations or backtest.list_models('model', args.model_dir)
+    gm = global_model.train(stations, sp.parse_years(args.years), args.dir,
+               sample=args.sample, max_iter=args.max_iter)
+    joblib.dump(gm, os.path.join(args.model_dir, GLOBAL_MODEL_FN), compress=3)
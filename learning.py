@@ -0,0 +1,110 @@
+# sklearn based transformers used by the pre-trained models
+#
+# These live outside of seattle_parking so that reading data and
+# searching stations does not require sklearn. Pickled models refer to
+# them as seattle_parking.TimeSplitter etc., which seattle_parking
+# resolves lazily from here.
+import pandas as pd
+import numpy as np
+
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from seattle_parking import trig
+
+class TimeSplitter(BaseEstimator, TransformerMixin):
+    """Split timestamps into separate columns of ['mon', 'day', 'dow',
+    'doy', 'hr', 'min']. If include_year=True, also include 'yr' in
+    the result.
+
+    This is to be used as part of a ColumnTransformer
+
+    """
+    __module__ = 'seattle_parking' # keep pickles compatible with existing models
+
+    def __init__(self, include_year=False):
+        self.include_year = include_year
+
+    def fit(self,X=None,y=None):
+        return self
+
+    def __sklearn_is_fitted__(self):
+        return True # stateless
+    
+    def transform(self,X):
+        """ this assumes X is a series of timestamps """
+        X = X.astype('datetime64')
+        dt = X.dt
+        res = {}
+        if self.include_year:
+            res = {'yr': dt.year}
+        res.update({
+            'mon': dt.month,
+            'day': dt.day,
+            'dow': dt.day_of_week,
+            'doy': dt.day_of_year,
+            'hr': dt.hour,
+            'min': dt.minute,
+        })
+        
+        return pd.DataFrame(res).reset_index(drop=True)
+
+class TrigTransformer(BaseEstimator, TransformerMixin):
+    """Apply trignometric functions to selected columns with customizable
+    period and harmonics """
+    __module__ = 'seattle_parking'
+
+    def __init__(self, concat=True, h=[1,2], plan=None):
+        """Apply trignometric transformation.
+
+        h: harmonics to apply
+
+        concat: if True, return concat of raw input and the trig
+        transformations. Otherwise, just return the trig
+        transformations
+
+        plan should be a dict where each key value pair has the form
+        column: (period, [harmonics]), e.g., 'mon': (12,[1,2,3]),
+        where `mon' is the name of a column in the data to be
+        transformed. Harmonics specified in kwargs will override the
+        `global' <h>
+        
+        default: apply to dow (day_of_week), doy (day_of_year), hr, min, with harmonics [1,2]
+
+        """
+        # NB: MUST save input variables AND under the same name,
+        # otherwise will cause error if put inside a ColumnTransformer.
+        self.concat = concat
+        self.h = h
+
+        self.plan = plan
+
+    def fit(self, X=None, y=None):
+        return self
+
+    def __sklearn_is_fitted__(self):
+        return True
+
+    def transform(self, X):
+        # default if plan is None
+        h = self.h
+        plan = self.plan or {
+            'doy': (365.25, h),
+            'dow': (5, h), # only work days, so period = 5
+            'hr': (10,h), # only 8 am to 17:55 pm
+            'min': (60,h)
+        }
+
+        
+        data = []
+        label = []
+
+        for column, (period, harmonics) in plan.items():
+            for f in (np.sin, np.cos):
+                for h in harmonics:
+                    label.append(f'{f.__name__}_{column}_{h}')
+                    func = trig(f, period/h)
+                    data.append(func(X[column]))
+        trig_data = pd.DataFrame(np.asarray(data).T, columns = label)
+        if self.concat:
+            return pd.concat([X,trig_data], axis=1)
+        return trig_data
@@ -0,0 +1,249 @@
+# Load test of the app's search flow with concurrent sessions
+#
+# Usage:
+#   python loadtest.py --sessions 16 --actions 20
+#   python loadtest.py --sessions 64 --think 2 --engine empirical --out timings.csv
+#
+# Each simulated session is a thread, as are Streamlit's sessions, and
+# goes through the same steps as a UI cycle of app.py, without a
+# browser, with the settings and state handling of appstate.py: the
+# search (appstate.start_search), the map of update_map_info
+# (mapper.build_map, rendered to html as st_folium would), and the
+# heatmap of plot_predictions, painted again once the other stations
+# and the rest of the day are scored.
+#
+# Sessions click around a few hotspots, move the distance slider and
+# time picker, and page through results. Reports latency percentiles
+# per action, throughput and peak RSS of the process. Actions that the
+# app would not offer, such as changing page before there are results
+# or when there is only one page, change nothing and are left out.
+import argparse
+import datetime
+import random
+import resource
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from time import perf_counter, sleep
+
+import numpy as np
+import pandas as pd
+
+import model
+import appstate
+from model import MAX_DIST, BLOCK_MILES
+from appstate import STATIONS_PERPAGE, PLOT_HEIGHT, PLOT_COL_WIDTH
+from compare_models import DESTINATIONS
+from mapper import build_map
+from plotter import plot_predictions, compute_width
+
+TIME_SLOTS = [ x.strftime('%H:%M') for x in pd.date_range('8:00', '17:55', freq='5min') ]
+
+# Where people click: destinations within the coverage of the shipped
+# models, see compare_models.py. Clicks scatter around them by
+# CLICK_SPREAD degrees (about 200 m)
+HOTSPOTS = DESTINATIONS
+CLICK_SPREAD = 0.002
+MAP_SPAN = 0.005 # half size of the map bounds around a click, in degrees
+
+# Relative frequency of user actions after the first click
+ACTIONS = {'click': 4, 'slider': 2, 'time': 2, 'page': 2}
+
+class Session:
+    """ state of one simulated user, a stand-in for st.session_state """
+    def __init__(self, rng, engine, model_dir):
+        self.rng = rng
+        self.engine = engine
+        self.model_dir = model_dir
+        self.location = None
+        self.dist = 1 # in blocks, as the slider
+        self.date = datetime.date.today() + datetime.timedelta(days=rng.randrange(7))
+        self.time = '11:00'
+        self.state = {} # as SS in app.py, see appstate.py
+
+    def next_action(self):
+        if self.location is None:
+            return 'click'
+        return self.rng.choices(list(ACTIONS), weights=list(ACTIONS.values()))[0]
+
+    def act(self, action):
+        """ change state as the UI would for <action>, and run the
+        resulting UI cycle. Returns dict of seconds per step, or None
+        if the app would not offer <action> (see module notes) """
+        rng = self.rng
+        if action == 'click':
+            # mostly near the last click, sometimes a new hotspot
+            if self.location is None or rng.random() < 0.3:
+                lat, lng = rng.choice(HOTSPOTS)
+            else:
+                lat, lng = self.location
+            self.location = (lat + rng.gauss(0, CLICK_SPREAD), lng + rng.gauss(0, CLICK_SPREAD))
+        elif action == 'slider':
+            self.dist = rng.randint(1, MAX_DIST)
+        elif action == 'time':
+            self.time = rng.choice(TIME_SLOTS)
+        elif action == 'page':
+            predictions = self.state.get('predictions', None)
+            if predictions is None:
+                return None
+            pmax = ceil(len(predictions.columns) / STATIONS_PERPAGE)
+            if pmax <= 1:
+                return None
+            self.state['page'] = self.state['page'] % pmax + 1
+            return self.render()
+        return {**self.update_stage(), **self.render()}
+
+    def update_stage(self):
+        """ as app.update_stage """
+        t = {}
+        t0 = perf_counter()
+        search_params = {'location': self.location, 'date': self.date, 'time': self.time,
+                         'dist': self.dist * BLOCK_MILES}
+        stations = appstate.start_search(self.state, search_params, self.engine, self.model_dir)
+        t['search'] = perf_counter() - t0
+
+        t0 = perf_counter()
+        self.draw_map(stations)
+        t['map'] = perf_counter() - t0
+        return t
+
+    def draw_map(self, stations):
+        """ as st_folium drawing the map of mapper.update_map_info """
+        location = self.state['search_params']['location']
+        bounds = [[location[0] - MAP_SPAN, location[1] - MAP_SPAN],
+                  [location[0] + MAP_SPAN, location[1] + MAP_SPAN]]
+        build_map(location, bounds, stations).get_root().render()
+
+    def render(self):
+        """ as the prediction panel of app.py, waiting for the
+        background jobs where the app polls them """
+        state = self.state
+        if state['predictions'] is None:
+            return {}
+        page = state['page']
+        width = compute_width(PLOT_HEIGHT, PLOT_COL_WIDTH, len(state['predictions'].columns), page, STATIONS_PERPAGE)
+        def plot():
+            plot_predictions(state['predictions'], (width, PLOT_HEIGHT), page,
+                             perpage=STATIONS_PERPAGE, hline=self.time)
+
+        t = {}
+        t0 = perf_counter()
+        plot()
+        t['plot'] = perf_counter() - t0
+
+        t0 = perf_counter()
+        if state['pending'] is not None:
+            nstations = len(state['predictions'].columns)
+            if appstate.merge_pending(state, appstate.result(state['pending'], 'Scoring more stations')):
+                if state['predictions'] is None or len(state['predictions'].columns) != nstations:
+                    # stations were dropped: as app.py, redraw the map
+                    # and rerun
+                    self.draw_map(appstate.labelled_stations(state))
+                    t['pending'] = perf_counter() - t0
+                    rerun = self.render()
+                    return { k: t.get(k, 0) + rerun.get(k, 0) for k in {**t, **rerun} }
+                plot()
+        t['pending'] = perf_counter() - t0
+
+        t0 = perf_counter()
+        appstate.start_fill(state)
+        if state['filling'] is not None:
+            if appstate.merge_fill(state, appstate.result(state['filling'], 'Scoring the rest of the day')):
+                plot()
+        t['fill'] = perf_counter() - t0
+        return t
+
+def run_session(i, actions, think, seed, engine, model_dir, start):
+    """ run <actions> UI cycles of session <i>, pausing for an
+    exponentially distributed time of mean <think> seconds between
+    them. Returns a list of dicts, one per action """
+    rng = random.Random(seed * 100003 + i)
+    s = Session(rng, engine, model_dir)
+    start.wait()
+    res = []
+    for _ in range(actions):
+        if think > 0:
+            sleep(rng.expovariate(1 / think))
+        action = s.next_action()
+        t0 = perf_counter()
+        try:
+            steps = s.act(action)
+            error = None
+        except Exception as e:
+            print(f'Session {i} failed at {action}: {e!r}', file=sys.stderr)
+            steps, error = {}, repr(e)
+        predictions = s.state.get('predictions', None)
+        res.append({'session': i, 'action': action, 'seconds': perf_counter() - t0,
+                    'stations': 0 if predictions is None else len(predictions.columns),
+                    'noop': steps is None, 'error': error, **(steps or {})})
+    return res
+
+def peak_rss_mb():
+    """ peak resident set size of this process so far """
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb / 1024 if sys.platform != 'darwin' else kb / 1024**2 # bytes on macOS
+
+def loadtest(sessions=8, actions=20, think=0.0, seed=0, engine='auto', model_dir='models/', prewarm=False):
+    """ run <sessions> concurrent sessions of <actions> each
+
+    returns (dataframe of one row per action, dict of overall metrics)
+    """
+    if prewarm:
+        model.prewarm(model_dir=model_dir, engine=engine)
+    rss0 = peak_rss_mb()
+
+    start = threading.Event()
+    with ThreadPoolExecutor(max_workers=sessions, thread_name_prefix='session') as pool:
+        futures = [ pool.submit(run_session, i, actions, think, seed, engine, model_dir, start) for i in range(sessions) ]
+        t0 = perf_counter()
+        start.set()
+        rows = [ r for f in futures for r in f.result() ]
+        wall = perf_counter() - t0
+
+    df = pd.DataFrame(rows)
+    ok = df[df.error.isna() & ~df.noop]
+    overall = {
+        'sessions': sessions,
+        'actions': int((~df.noop).sum()),
+        'noops': int(df.noop.sum()),
+        'errors': int(df.error.notna().sum()),
+        'wall_seconds': wall,
+        'actions_per_sec': len(ok) / wall,
+        'rss_before_mb': rss0,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    return df, overall
+
+def latency_table(df):
+    """ p50/p95/p99 latency in seconds per action, and over all actions,
+    leaving out no-op actions """
+    ok = df[df.error.isna() & ~df.noop]
+    groups = [ (a, g.seconds.values) for a, g in ok.groupby('action') ] + [('all', ok.seconds.values)]
+    return pd.DataFrame([ {'action': a, 'count': len(v), 'mean': v.mean(),
+                           **{ f'p{q}': np.percentile(v, q) for q in (50, 95, 99) }}
+                          for a, v in groups if len(v) ]).set_index('action')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the app search flow with concurrent sessions')
+    parser.add_argument('--sessions', type=int, default=8, help='concurrent sessions')
+    parser.add_argument('--actions', type=int, default=20, help='UI actions per session')
+    parser.add_argument('--think', type=float, default=0.0, help='mean pause between actions, in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=model.ENGINES, default=appstate.MODEL_ENGINE)
+    parser.add_argument('--model-dir', default=appstate.MODEL_DIR)
+    parser.add_argument('--prewarm', action='store_true', help='pre-warm as at server start before the sessions')
+    parser.add_argument('--out', help='write per action timings to this csv')
+    args = parser.parse_args()
+
+    df, overall = loadtest(args.sessions, args.actions, args.think, args.seed, args.engine, args.model_dir, args.prewarm)
+    if args.out:
+        df.to_csv(args.out, index=False)
+    print(latency_table(df).to_string(float_format='%.3f'))
+    print()
+    steps = [ c for c in ('search', 'map', 'plot', 'pending', 'fill') if c in df ]
+    print('mean seconds per step')
+    print(df[~df.noop][steps].mean().to_string(float_format='%.3f'))
+    print()
+    for k, v in overall.items():
+        print('%-16s %s'%(k, '%.4g'%v if isinstance(v, float) else v))
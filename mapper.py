@@ -5,7 +5,7 @@ import folium
 from folium.plugins import MarkerCluster, BeautifyIcon
 from single_marker import SingleClickForMarker
 
-import seaborn as sns
+# NB: seaborn is imported in add_stations() when first needed
 
 SPACE_NEEDLE = (47.6205, -122.3493)
 STATION_PALETTE='colorblind'
@@ -59,8 +59,10 @@ def add_stations(m,s, icon_size=ICON_SIZE, font_size='+2.5'):
     #
     # NB: properties like icon_size are translated in via **kwargs of
     # BeautifyIcon.__init__. For a list of properties, see [1]
-    nstations = len(s)
-    palette = sns.color_palette(STATION_PALETTE, nstations).as_hex()
+    import seaborn as sns
+    # one color per label, as in plotter.plot_predictions. Labels are
+    # 1, 2, ..., but some may have been dropped since
+    palette = sns.color_palette(STATION_PALETTE, int(s.sourceelementkey.max())).as_hex()
     for _, (sid, lat,lng,tmin,tmax,scount,dist) in s[
             ['sourceelementkey', 'latitude', 'longitude','time_limit_min', 'time_limit_max', 'space_count', 'dist']
     ].iterrows():
@@ -103,11 +105,15 @@ def update_map_info(map_data, stations):
     # not because of new click but because of updated search params
     last_click = last_click or ss['search_params']['location']
 
+    ss['new_map'] = build_map(last_click, map_bounds, stations)
+
+def build_map(last_click, map_bounds, stations=None):
+    """ a new map with a destination marker at <last_click>, fit into
+    <map_bounds>, and markers for <stations> if not None """
     m = create_empty_map()
     if stations is not None:
         add_stations(m, stations)
-    restore_map(m, last_click, map_bounds)
-    ss['new_map'] = m
+    return restore_map(m, last_click, map_bounds)
 
 def update_map_info_lazy(map_data, stations):
     """Check if last_click and map_bounds have changed since refresh. Save
@@ -135,10 +141,6 @@ def update_map_info_lazy(map_data, stations):
     if changed:
         # if map info changed, propose a new map to draw for next
         # refresh
-        m = create_empty_map()
-        if stations is not None:
-            add_stations(m, stations)
-        restore_map(m, last_click, map_bounds)
-        ss['new_map'] = m
+        ss['new_map'] = build_map(last_click, map_bounds, stations)
 
 
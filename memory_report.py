@@ -0,0 +1,70 @@
+# Compare memory of data frames read with and without compact dtypes
+#
+# Usage:
+#   python memory_report.py                                  # station catalog and weather only
+#   python memory_report.py --dir data/station_data --years 2012-2017 11133 11134
+#
+# Station data files are expected at <dir>/<year>/<station>.csv.gz, see
+# seattle_parking.read_parking_data_multiyear
+import argparse
+import os
+
+import pandas as pd
+import seattle_parking as sp
+
+def frame_memory(df):
+    """ bytes held by <df>, including python objects in object columns """
+    return df.memory_usage(deep=True).sum()
+
+def compare(name, read, columns=False):
+    """ read(compact) should return a dataframe. Returns a one row
+    summary, and prints per column dtypes and memory if <columns> """
+    before, after = read(False), read(True)
+    if columns:
+        print(f'\n{name}')
+        print(pd.DataFrame({
+            'dtype': before.dtypes.astype(str),
+            'bytes': before.memory_usage(deep=True, index=False),
+            'compact dtype': after.dtypes.astype(str),
+            'compact bytes': after.memory_usage(deep=True, index=False),
+        }).to_string())
+    return {'data': name, 'rows': len(before),
+            'MB': frame_memory(before) / 2**20, 'compact MB': frame_memory(after) / 2**20}
+
+def report(stations=(), years=(), dir='data/station_data', columns=False,
+           coord_fn='data/pay_station_coord.csv', spacetime_fn='data/pay_station_time_limit_space_count.csv',
+           weather_fn='data/seattle_weather.csv.gz'):
+    rows = [
+        compare('station catalog', lambda c: sp.read_station_catalog(coord_fn, spacetime_fn, compact=c), columns),
+        compare('weather', lambda c: sp.read_noaa_weather_data(weather_fn, compact=c), columns),
+    ]
+
+    if stations and not os.path.isdir(dir):
+        print(f'No station data directory {dir}')
+        stations = ()
+
+    for station in stations:
+        raw = { c: sp.read_parking_data_multiyear(station, years, dir, compact=c) for c in (False, True) }
+        if raw[False] is None:
+            continue
+        rows.append(compare(f'{station} raw', raw.get, columns))
+        rows.append(compare(f'{station} resampled', lambda c: sp.resample_parking_data(raw[c], compact=c), columns))
+
+    res = pd.DataFrame(rows).set_index('data')
+    if len(stations) > 1:
+        for kind in ('raw', 'resampled'):
+            res.loc[f'all {kind}'] = res[res.index.str.endswith(f' {kind}')].sum()
+    res['rows'] = res['rows'].astype(int)
+    res['ratio'] = res['compact MB'] / res['MB']
+    print()
+    print(res.to_string(float_format='%.3f'))
+    return res
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare memory with and without compact dtypes')
+    parser.add_argument('stations', nargs='*', type=int, help='sourceelementkey of stations to read')
+    parser.add_argument('--dir', default='data/station_data', help='base directory of station data')
+    parser.add_argument('--years', default='2012-2017', help='e.g. 2012-2017 or 2012,2014')
+    parser.add_argument('--columns', action='store_true', help='also show per column breakdown')
+    args = parser.parse_args()
+    report(args.stations, sp.parse_years(args.years), args.dir, args.columns)
@@ -1,15 +1,55 @@
 # Module for calling pickled models to predict parking
 # Time-stamp: <2022-05-17 11:56:02 zshuang>
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import lru_cache
+from time import perf_counter
 import os
+import sys
+import threading
 import pandas as pd
 
 #from seattle_parking import * #read_noaa_weather_data, find_nearby_stations, SPACE_NEEDLE
 import seattle_parking as sp
 #from seattle_parking import TimeSplitter
+import model_store
+from global_model import GLOBAL_MODEL_FN
 
-import joblib
+# NB: joblib (and sklearn, through unpickling) is imported on first
+# model load rather than here, to keep app startup light
+
+# Number of unpickled models to keep in memory
+MODEL_CACHE_SIZE = 256
+
+# Number of threads loading models. Reading and decompressing release
+# the GIL, so loading in parallel keeps the disk and cores busy
+LOAD_WORKERS = 8
+
+# Hold the long-lived station catalog in compact dtypes, see
+# sp.read_station_catalog
+COMPACT_DTYPES = True
+
+# Walking distance, as offered by the app's slider: an average city
+# block in miles, and the most blocks
+BLOCK_MILES = 0.07
+MAX_DIST = 10
+
+# Largest search radius in miles, and number of destinations whose
+# results are kept, see search()
+MAX_RADIUS = MAX_DIST * BLOCK_MILES
+SEARCH_CACHE_SIZE = 64
+
+# Number of background extensions (see extend_search) waiting to run.
+# Older ones are dropped, their destinations being likely stale
+EXTEND_QUEUE_SIZE = 4
+
+# Destinations are snapped to a grid of SNAP_DEGREES (about 33 x 22 m
+# in Seattle), and stations near a grid cell are looked up once per
+# cell and radius, for up to CELL_CACHE_SIZE of them, see snap()
+SNAP_DEGREES = 0.0003
+CELL_CACHE_SIZE = 1024
 
 def get_module_path():
     try:
@@ -17,58 +57,300 @@ def get_module_path():
     except:
         return '.'
 
-def load_models_near(location = sp.SPACE_NEEDLE, within = 0.3, station_coord_fn='data/pay_station_coord.csv', model_dir = 'models/',station_spacetime_fn='data/pay_station_time_limit_space_count.csv'):
-    """ load models for stations within some distance of a target location 
+def get_store():
+    """ the shared store (see model_store.py) named by the environment
+    variable SEAPARK_STORE, if it is ready. Else None """
+    store = os.environ.get('SEAPARK_STORE')
+    return store if store and model_store.ready(store) else None
 
-    returns (None, None) if no stations found, or no model available
-    else, returns (models_dict, stations_df)
+def get_station_catalog(coord_fn='data/pay_station_coord.csv', spacetime_fn='data/pay_station_time_limit_space_count.csv'):
+    """ station catalog as returned by sp.read_station_catalog, read once
+    per process, from the shared store if there is one. A copy read
+    from files before the store was ready (e.g. by the prewarm at
+    startup) is dropped once it is. Callers should NOT modify it in
+    place """
+    return _station_catalog(coord_fn, spacetime_fn, get_store())
+
+@lru_cache(maxsize=1)
+def _station_catalog(coord_fn, spacetime_fn, store):
+    if store:
+        return model_store.load_catalog(store)
+    return sp.read_station_catalog(coord_fn, spacetime_fn, compact=COMPACT_DTYPES)
+
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def load_model(path):
+    """ unpickle a single model, cached by path """
+    import joblib
+    return joblib.load(path)
+
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def load_empirical(path):
+    """ load a single empirical table (see empirical.py), cached by path """
+    from empirical import EmpiricalTable
+    return EmpiricalTable.load(path)
+
+@lru_cache(maxsize=MODEL_CACHE_SIZE)
+def load_stored(path):
+    """ load an empirical table from the shared store, with its arrays
+    memory-mapped. Cached by path """
+    return model_store.load(path)
+
+# Where predictions come from, see load_models_near
+ENGINES = ('model', 'auto', 'empirical', 'global')
+_LOADERS = {'model': load_model, 'empirical': load_empirical, 'global': load_model}
+
+def _load_one(engine, path, stored = False):
+    """ load a model, or print the error and return None if it fails """
+    try:
+        return load_stored(path) if stored else _LOADERS[engine](path)
+    except Exception as e:
+        print(f'Failed to load {path}: {e!r}', file=sys.stderr)
+        return None
+
+def iter_models(stations, workers = LOAD_WORKERS):
+    """Load models of <stations> (as returned by find_model_stations,
+    with columns 'engine', 'model_path' and 'stored') with <workers>
+    threads.
+
+    Yields (sid, model) as soon as each is loaded, so not necessarily
+    in the order of <stations>. A file shared by several stations (the
+    global model) is loaded once. Models that fail to load are
+    reported on stderr and skipped.
     """
-    stations = sp.find_nearby_stations(location, within, coord_fn=station_coord_fn, spacetime_fn=station_spacetime_fn)
+    jobs = {} # (engine, path, stored) => [sid, ...]
+    for sid, e, p, stored in stations[['sourceelementkey', 'engine', 'model_path', 'stored']].values:
+        jobs.setdefault((e, p, stored), []).append(sid)
+
+    if workers <= 1:
+        for job, sids in jobs.items():
+            m = _load_one(*job)
+            if m is not None:
+                yield from ( (sid, m) for sid in sids )
+        return
+
+    with ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'load_models') as pool:
+        futures = { pool.submit(_load_one, *job): sids for job, sids in jobs.items() }
+        for f in as_completed(futures):
+            m = f.result()
+            if m is not None:
+                yield from ( (sid, m) for sid in futures[f] )
+
+def snap(location, grid = SNAP_DEGREES):
+    """ center of the grid cell containing <location>, as a (lat, lng)
+    tuple. Clicks a few meters apart share a cell, and with it cached
+    stations and search results """
+    return tuple( round(round(x / grid) * grid, 7) for x in location )
+
+def cell_margin(cell, grid = SNAP_DEGREES):
+    """ miles from the center of <cell> to its farthest corner """
+    corners = [ (cell[0] + dlat, cell[1] + grid/2) for dlat in (-grid/2, grid/2) ]
+    return float(sp.latlng_dist(corners, cell).max())
+
+def nearest(stations, location, within):
+    """ <stations> within <within> miles of <location>, in order of
+    distance. Only distances to <stations> are computed, e.g. to the
+    candidates of a grid cell rather than to the whole catalog """
+    dist = sp.latlng_dist(stations[['latitude', 'longitude']], location)
+    return stations.assign(dist=dist).iloc[dist <= within].sort_values('dist')
+
+@lru_cache(maxsize=CELL_CACHE_SIZE)
+def _cell_stations(cell, within, station_coord_fn, station_spacetime_fn):
+    """ stations of the catalog within <within> miles of any point of
+    <cell>, with 'dist' from its center, or None. Shared by all
+    sessions, do NOT modify """
+    catalog = get_station_catalog(station_coord_fn, station_spacetime_fn)
+    stations = sp.find_nearby_stations(cell, within + cell_margin(cell), catalog=catalog)
     if len(stations) == 0: # nothing found
-        return None,None
-    model_path = lambda sid: os.path.join(model_dir, '%d.joblib'%sid)
-    model_exists = lambda p: os.path.exists(p)
+        return None
+    return stations
+
+def _listdir(d):
+    """ names of the files in directory <d>, empty if there is none """
+    try:
+        return set(os.listdir(d))
+    except OSError:
+        return set()
+
+def _with_models(stations, engine, model_dir, empirical_dir, table_ext):
+    """ <stations> that have a model of <engine>, with columns 'engine'
+    and 'model_path', or None. Models are looked up on every call (one
+    listing per directory), so that models added or removed while the
+    server runs are picked up """
+    models = _listdir(model_dir) if engine != 'empirical' else set()
+    tables = _listdir(empirical_dir) if engine in ('empirical', 'auto') else set()
+
+    def find_model(sid):
+        """ (engine, path) of the model to use for station <sid>, or (None, None) """
+        if engine == 'global':
+            return ('global', os.path.join(model_dir, GLOBAL_MODEL_FN)) if GLOBAL_MODEL_FN in models else (None, None)
+        if '%d.joblib'%sid in models:
+            return 'model', os.path.join(model_dir, '%d.joblib'%sid)
+        if '%d.%s'%(sid, table_ext) in tables:
+            return 'empirical', os.path.join(empirical_dir, '%d.%s'%(sid, table_ext))
+        return None, None
+
+    found = [ find_model(sid) for sid in stations.sourceelementkey ]
+    stations = stations.assign(engine = [ e for e,_ in found ], model_path = [ p for _,p in found ])
 
-    stations['model_path'] = stations.sourceelementkey.apply(model_path)
-    stations['model_exists'] = stations.model_path.apply(model_exists)
-    
     # only add existing models
-    stations = stations[stations.model_exists]
+    stations = stations[stations.engine.notna()]
 
     if len(stations) == 0: # no model available, perhaps not trained yet
+        return None
+    return stations
+
+def find_model_stations(location = sp.SPACE_NEEDLE, within = 0.3, station_coord_fn='data/pay_station_coord.csv', model_dir = 'models/',station_spacetime_fn='data/pay_station_time_limit_space_count.csv', engine = 'model', empirical_dir = 'empirical/', store = None, cell = False):
+    """ find stations within some distance of a target location that
+    have a model, without loading any. Arguments as in load_models_near
+
+    The stations near the grid cell of <location> (see snap()) are
+    looked up in the catalog once per cell and radius. Per location,
+    only the distances to those are computed, and which of them have a
+    model is checked.
+
+    cell: if True, return all stations within <within> of any point of
+    the grid cell of <location>, with 'dist' from the cell center, as
+    needed for results shared by the cell
+
+    returns None if there is none, else a dataframe of stations in
+    order of distance, with columns 'engine' (which kind of model),
+    'model_path' and 'stored' (if the path is in the shared store,
+    which only holds empirical tables)
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'engine should be one of {ENGINES}, got {engine!r}')
+
+    if store is None:
+        store = get_store()
+    table_ext = 'npz'
+    if store:
+        # tables in the store are uncompressed joblib dumps. Models are
+        # not in the store, see model_store.py
+        empirical_dir = model_store.store_empirical_dir(store)
+        table_ext = 'joblib'
+
+    stations = _cell_stations(snap(location), within, station_coord_fn, station_spacetime_fn)
+    if stations is None:
+        return None
+    if not cell:
+        stations = nearest(stations, location, within)
+    stations = _with_models(stations, engine, model_dir, empirical_dir, table_ext)
+    if stations is None:
+        return None
+    return stations.assign(stored = bool(store) & (stations.engine == 'empirical'))
+
+def load_models_near(location = sp.SPACE_NEEDLE, within = 0.3, station_coord_fn='data/pay_station_coord.csv', model_dir = 'models/',station_spacetime_fn='data/pay_station_time_limit_space_count.csv', engine = 'model', empirical_dir = 'empirical/', workers = LOAD_WORKERS, stream = False, store = None, cell = False):
+    """ load models for stations within some distance of a target location 
+
+    engine: one of ENGINES
+      'model': pickled models in <model_dir>. Stations without one are dropped
+      'auto': pickled models where available, empirical tables in
+              <empirical_dir> for the rest
+      'empirical': empirical tables only, a lot cheaper to load and score
+      'global': a single model for all stations, GLOBAL_MODEL_FN in
+                <model_dir>, see global_model.py
+    workers: number of threads loading models
+    stream: if True, return an iterator of (sid, model) instead of a
+    dict, see iter_models
+    store: the shared store to load empirical tables from instead of
+    <empirical_dir>. By default get_store(); False to not use one
+    cell: if True, load models for the whole grid cell of <location>,
+    see find_model_stations
+
+    returns (None, None) if no stations found, or no model available
+    else, returns (models_dict, stations_df). Column 'engine' of
+    stations_df tells which kind of model each station got. Stations
+    whose model fails to load are left out of both, except with
+    <stream>, where stations_df lists all stations to be loaded
+    """
+    stations = find_model_stations(location, within, station_coord_fn, model_dir, station_spacetime_fn,
+                                   engine, empirical_dir, store, cell)
+    if stations is None:
         return None,None
 
-    models = dict(( (sid, joblib.load(p)) for sid,p in stations[['sourceelementkey', 'model_path']].values) )
+    if stream:
+        return iter_models(stations, workers), stations
+
+    models = dict(iter_models(stations, workers))
+    if len(models) == 0: # all failed to load
+        return None,None
+    # keep the order of stations
+    stations = stations[stations.sourceelementkey.isin(models)]
+    models = { sid: models[sid] for sid in stations.sourceelementkey }
 
     return models, stations
         
-def impute_weather(date=datetime.today(), wwin=10):
-    """ impute weather information for a given day_of_year in a +/- wwin day window """
-    doy = date.timetuple().tm_yday # day of year for input date
+def weather_climatology(wwin=10):
+    """ mean weather of each day_of_year (1 to 366), averaged over a +/-
+    wwin day window across all years on record. Taken from the shared
+    store if there is one, as soon as it is ready """
+    return _weather_climatology(wwin, get_store())
+
+# one entry, so that a copy read from files is dropped once the store
+# is ready: the app only ever uses one wwin
+@lru_cache(maxsize=1)
+def _weather_climatology(wwin, store):
+    if store:
+        res = model_store.load_climatology(store, wwin)
+        if res is not None:
+            return res
 
     # NB: weather data path is semi hard-coded
     weather_path = os.path.join(get_module_path(), 'data/seattle_weather.csv.gz')
     
     df = sp.read_noaa_weather_data(weather_path)
+    doys = df.index.day_of_year
 
-    wsel = abs(df.index.day_of_year - doy) <= wwin
-    res = df.iloc[wsel].apply('mean')
+    res = pd.DataFrame({ doy: df.iloc[abs(doys - doy) <= wwin].apply('mean') for doy in range(1, 367) }).T
+    res.index.name = 'doy'
     return res
 
-def predict(models, stations, date, time = '8:00', wwin=10, reformat_date = True, return_proba = False):
-    """(models, stations) are returns of load_models_near, but it is the
-    user's responsibility to check if either of them is None (meaning
-    no model/station available)
+def impute_weather(date=datetime.today(), wwin=10):
+    """ impute weather information for a given day_of_year in a +/- wwin day window """
+    doy = date.timetuple().tm_yday # day of year for input date
+    return weather_climatology(wwin).loc[doy]
 
-    date: a datetime.date() object as returned from streamlit
-    time: a string
-    wwin: weather window in days
-    reformat_date: if True, replace datetime index with time-of-day string
-    return_proba: if True, return the probability of having parking available
-    
-    for a given date, will use days within a window of +/-
-    weather_window_days to inpute weather info
+def prewarm(location = sp.SPACE_NEEDLE, within = 0.3, model_dir = 'models/', wwin=10, engine = 'model'):
+    """Fill the caches of station catalog, weather climatology and the
+    models of <engine> near <location>, so that the first search does
+    not pay for them. Meant to be called once at server start, with
+    the engine the server searches with.
+
+    returns a dict of seconds spent on each step
+    """
+    timing = {}
+    t0 = perf_counter()
+    get_station_catalog()
+    timing['station_catalog'] = perf_counter() - t0
+
+    t0 = perf_counter()
+    weather_climatology(wwin)
+    timing['weather_climatology'] = perf_counter() - t0
+
+    t0 = perf_counter()
+    load_models_near(location, within, model_dir = model_dir, engine = engine)
+    timing['models'] = perf_counter() - t0
+    return timing
+
+def time_slots(date):
+    """ a time series from 8:00 to 17:55 with 5min freq on <date> """
+    return pd.timedelta_range('8h', '18h', freq='5min')[:-1] + pd.to_datetime(date)
 
+def in_window(ts, time, window):
+    """ boolean mask of timestamps <ts> within +/- <window> minutes of
+    <time> (a 'HH:MM' string) on the same day """
+    t = ts.normalize() + (pd.to_datetime(time) - pd.to_datetime('00:00'))
+    return abs(ts - t) <= pd.Timedelta(minutes=window)
+
+def score(models, stations, ts, date, wwin=10, return_proba = False):
+    """ score <models> at timestamps <ts>, see predict()
+
+    models: dict of sid => model, or an iterable of (sid, model) pairs
+    such as returned by load_models_near(..., stream=True), which is
+    scored as models come in
+
+    returns a dataframe with station ids as columns, in the order of
+    <stations>, and <ts> as index
     """
 
     # currently model needs the following input:
@@ -80,36 +362,64 @@ def predict(models, stations, date, time = '8:00', wwin=10, reformat_date = True
     # prcp
     # snow
     # snwd
-
-    # We will predict a full day's worth of time. User input time
-    # right now will not be considered, except perhaps in calculating
-    # a score to rank the parking lots
-    
     w = impute_weather(date, wwin)
-    # a time series from 8:00 to 17:55 with 5min freq on the input date
-    ts = pd.timedelta_range('8h', '18h', freq='5min')[:-1] + pd.to_datetime(date)
     X = pd.DataFrame(ts, columns=['occupancydatetime'])
     X[w.keys()] = w # broadcasting imputed weather info into X
 
-    # # We didn't save the parking space count of individual stations so
-    # # will just use some reasonable const here
-    # X['parkingspacecount'] = 5
-
+    space_count = stations.set_index('sourceelementkey').space_count
     def insert_spacecount(X,sid):
-        X['parkingspacecount'] = stations.set_index('sourceelementkey').loc[sid].space_count
+        X['parkingspacecount'] = space_count.loc[sid]
         return X
 
-    predictions = pd.DataFrame(
-        #{ sid: pd.Series(m.predict(X), index=ts) for sid,m in models.items() }
-        { sid: pd.Series(
-            m.predict_proba(
-                insert_spacecount(X,sid)
-            )[:,1] if return_proba else m.predict(X),
-            index=ts) for sid,m in models.items() }
-        # dict[sid] => predicted Series bools.
-    )
+    items = models.items() if hasattr(models, 'items') else models
+    columns = {} # sid => predicted bools or probabilities
+    shared = {} # id(model) => (model, [sid, ...]) for models scoring many stations at once
+    for sid, m in items:
+        if hasattr(m, 'predict_proba_stations'): # e.g., global_model.GlobalModel
+            shared.setdefault(id(m), (m, []))[1].append(sid)
+            continue
+        X = insert_spacecount(X,sid)
+        if hasattr(m, 'predict_proba_climatology'): # e.g., empirical.EmpiricalTable
+            # the weather in X is imputed, see impute_weather()
+            p = m.predict_proba_climatology(X)[:,1]
+            columns[sid] = p if return_proba else p > 0.5
+            continue
+        columns[sid] = m.predict_proba(X)[:,1] if return_proba else m.predict(X)
+
+    for m, sids in shared.values():
+        # one batch over (time slots x stations)
+        p = m.predict_proba_stations(X, stations.set_index('sourceelementkey').loc[sids])
+        for j, sid in enumerate(sids):
+            columns[sid] = p[:,j] if return_proba else p[:,j] > 0.5
+
+    predictions = pd.DataFrame(columns, index=ts)
+    predictions = predictions[[ sid for sid in stations.sourceelementkey if sid in predictions.columns ]]
     # columns are station ids, index is the time series, so
     # predictions.loc[timeslot, station] = true/false
+    return predictions
+
+def predict(models, stations, date, time = '8:00', wwin=10, reformat_date = True, return_proba = False, window = None):
+    """(models, stations) are returns of load_models_near, but it is the
+    user's responsibility to check if either of them is None (meaning
+    no model/station available)
+
+    date: a datetime.date() object as returned from streamlit
+    time: a string, the requested arrival time
+    wwin: weather window in days
+    reformat_date: if True, replace datetime index with time-of-day string
+    return_proba: if True, return the probability of having parking available
+    window: if given, only score time slots within +/- <window>
+    minutes of <time>. Other slots of the day are left as NaN, see
+    fill_predictions(). If None, score the full day
+    
+    for a given date, will use days within a window of +/-
+    weather_window_days to inpute weather info
+
+    """
+    ts = time_slots(date)
+    scored = ts if window is None else ts[in_window(ts, time, window)]
+
+    predictions = score(models, stations, scored, date, wwin, return_proba).reindex(ts)
 
     # # Eliminate stations with no parking available
     # has_parking = predictions.apply(any).index # stations that has parking
@@ -118,7 +428,276 @@ def predict(models, stations, date, time = '8:00', wwin=10, reformat_date = True
     # Reformat index to show time of day only
     if reformat_date:
         predictions.index = predictions.index.strftime('%H:%M')
-    #stations = 
-    
     
     return predictions
+
+def fill_predictions(models, stations, predictions, date, wwin=10, return_proba = False):
+    """Score the time slots left as NaN by predict(..., window=...).
+
+    The columns of <predictions> are assumed to correspond, in order,
+    to the rows of <stations> (so they may have been renamed since).
+    Stations not in <models> are left as they are.
+    Returns a new dataframe, or <predictions> itself if there is
+    nothing to fill.
+    """
+    cols = [ i for i,sid in enumerate(stations.sourceelementkey) if sid in models ]
+    missing = predictions.iloc[:, cols].isna().any(axis=1).values
+    if not missing.any():
+        return predictions
+    ts = time_slots(date)[missing]
+    sids = stations.sourceelementkey.values[cols]
+    rest = score({ sid: models[sid] for sid in sids }, stations, ts, date, wwin, return_proba)
+
+    res = predictions.copy()
+    res.iloc[missing, cols] = rest[sids].values
+    return res
+
+_fill_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='fill_predictions')
+
+def fill_predictions_later(models, stations, predictions, date, wwin=10, return_proba = False):
+    """ fill_predictions() in the background, off the request path.
+    Returns a Future of its result """
+    return _fill_pool.submit(fill_predictions, models, stations, predictions, date, wwin, return_proba)
+
+def rank_stations(predictions, time, window):
+    """Rank the columns (stations) of <predictions> by their mean
+    predicted availability within +/- <window> minutes of <time>. Ties
+    keep their original (i.e., distance) order
+
+    returns the ranked column labels
+    """
+    ts = pd.to_datetime(predictions.index.astype(str))
+    mean = predictions[in_window(ts, time, window)].astype(float).mean()
+    # stations not scored yet (all NaN) go last
+    return mean.sort_values(ascending=False, kind='stable').index
+
+def rank_results(predictions, stations, time, window):
+    """ reorder <predictions> and <stations> together by rank_stations().
+    The columns of <predictions> are assumed to correspond, in order,
+    to the rows of <stations>, and keep their labels
+
+    returns (predictions, stations)
+    """
+    order = rank_stations(predictions, time, window)
+    pos = predictions.columns.get_indexer(order)
+    return predictions[order], stations.iloc[pos].reset_index(drop=True)
+
+
+################################################################
+# Search with reuse across radii and nearby destinations
+#
+# Results are kept per grid cell of the destination (see snap()), at
+# the largest radius computed so far, and cover every station within
+# that radius of any point of the cell. A destination in the cell, with
+# that or a smaller radius, is then answered by computing its
+# distances to the cached stations.
+_searches = OrderedDict() # key => dict(within, time, window, predictions, stations, models)
+_searches_lock = threading.Lock()
+_extending = OrderedDict() # key => Future of its extension, queued or running
+_extend_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='extend_search')
+
+def _search_key(location, date, engine, model_dir):
+    return (snap(location), date, engine, model_dir)
+
+def _covers(entry, within, time, window):
+    """ if a cached search entry can answer a query """
+    if entry['within'] < within:
+        return False
+    if entry['window'] is None: # full day scored
+        return True
+    return window is not None and entry['time'] == time and entry['window'] >= window
+
+def _subset(entry, location, within):
+    """ (predictions, stations, models) of a cached entry within <within> miles of <location> """
+    stations = entry['stations']
+    if stations is None: # nothing found, even at a larger radius
+        return None,None,None
+    stations = nearest(stations, location, within)
+    if len(stations) == 0:
+        return None,None,None
+    sids = stations.sourceelementkey.values
+    models = { sid: entry['models'][sid] for sid in sids }
+    return entry['predictions'][sids], stations, models
+
+def _store(key, entry):
+    with _searches_lock:
+        old = _searches.get(key)
+        # keep whichever covers more
+        if old is None or _covers(entry, old['within'], old['time'], old['window']):
+            _searches[key] = entry
+        _searches.move_to_end(key)
+        while len(_searches) > SEARCH_CACHE_SIZE:
+            _searches.popitem(last=False)
+
+def clear_caches():
+    """ forget cached searches and loaded models, e.g. to time cold searches """
+    with _searches_lock:
+        _searches.clear()
+    for f in (load_model, load_empirical, load_stored):
+        f.cache_clear()
+
+def search(location, within, date, time = '8:00', window = None, engine = 'model', model_dir = 'models/', **kwargs):
+    """Load models near <location> and predict availability on <date>,
+    reusing cached results of an earlier search in the same grid cell
+    (see snap()) with a larger or equal radius.
+
+    time, window: see predict()
+    engine, model_dir, kwargs: passed on to load_models_near
+
+    returns (predictions, stations, models), or (None, None, None) if
+    no station or model is available. Predictions are probabilities,
+    with station ids as columns. Returned objects are copies and can
+    be modified by the caller.
+    """
+    key = _search_key(location, date, engine, model_dir)
+    with _searches_lock:
+        entry = _searches.get(key)
+        if entry is not None and _covers(entry, within, time, window):
+            _searches.move_to_end(key)
+            return _subset(entry, location, within)
+
+    # score the whole cell, for other destinations in it
+    models_iter, stations = load_models_near(location, within, model_dir = model_dir, engine = engine, stream = True,
+                                             cell = True, **kwargs)
+    models = predictions = None
+    if models_iter is not None:
+        # score models as they are loaded, and keep them for later
+        models = {}
+        def collect():
+            for sid, m in models_iter:
+                models[sid] = m
+                yield sid, m
+        predictions = predict(collect(), stations, date, time = time, return_proba = True, window = window)
+        stations = stations[stations.sourceelementkey.isin(models)]
+        if len(stations) == 0: # all failed to load
+            models = predictions = stations = None
+    entry = dict(within = within, time = time, window = window,
+                 predictions = predictions, stations = stations, models = models)
+    _store(key, entry)
+    return _subset(entry, location, within)
+
+def extend_search(location, date, within = MAX_RADIUS, engine = 'model', model_dir = 'models/', **kwargs):
+    """In the background, score the full day at <within> miles around
+    <location>, so that later searches at the same destination with
+    any radius up to <within> are answered from cache.
+
+    Does nothing if that is already cached or under way. At most
+    EXTEND_QUEUE_SIZE jobs wait to run, the oldest being dropped.
+    Returns the Future of the background job, or None
+    """
+    key = _search_key(location, date, engine, model_dir)
+
+    def job():
+        # nobody waits on the Future, so report failures here
+        try:
+            search(location, within, date, engine = engine, model_dir = model_dir, **kwargs)
+        except Exception as e:
+            print(f'Extending the search around {location} failed: {e!r}', file=sys.stderr)
+        finally:
+            with _searches_lock:
+                _extending.pop(key, None)
+
+    with _searches_lock:
+        entry = _searches.get(key)
+        if key in _extending or (entry is not None and _covers(entry, within, None, None)):
+            return None
+        future = _extending[key] = _extend_pool.submit(job)
+        queued = [ k for k, f in _extending.items() if not (f.running() or f.done()) ]
+        for k in queued[:-EXTEND_QUEUE_SIZE]:
+            if _extending[k].cancel():
+                del _extending[k]
+    return future
+
+_progress_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='search_progressive')
+
+def search_progressive(location, within, date, time = '8:00', window = None, first = 8, engine = 'model', model_dir = 'models/',
+                       workers = LOAD_WORKERS, **kwargs):
+    """Like search(), but only the <first> nearest stations are loaded
+    and scored before returning, so that the time to first result does
+    not depend on <within>. The other stations are scored in the
+    background, after which the whole result is cached as by search().
+
+    returns (predictions, stations, models, rest). <predictions> has a
+    column for each of <stations> (in order of distance), but only the
+    first <first> are scored, the rest being NaN. Those of the first
+    whose model failed to load are left out. <rest> is a Future of
+    (predictions, models) for the remaining stations, without those
+    whose model failed to load, which the caller should drop, or None if
+    there are none, or the whole result was in cache already. Returns
+    (None, None, None, None) if no station or model is available.
+
+    workers, kwargs: as for search()
+    """
+    key = _search_key(location, date, engine, model_dir)
+    with _searches_lock:
+        entry = _searches.get(key)
+        cached = entry is not None and _covers(entry, within, time, window)
+    if cached:
+        return search(location, within, date, time, window, engine, model_dir, workers = workers, **kwargs) + (None,)
+
+    # the whole cell is scored in the end, for other destinations in it
+    cell_stations = find_model_stations(location, within, model_dir = model_dir, engine = engine, cell = True, **kwargs)
+    if cell_stations is None:
+        return None,None,None,None
+    stations = nearest(cell_stations, location, within)
+    if len(stations) == 0:
+        return None,None,None,None
+    head = stations.iloc[:first]
+    tail = cell_stations[~cell_stations.sourceelementkey.isin(head.sourceelementkey)]
+    shown = set(stations.sourceelementkey)
+
+    models = dict(iter_models(head, workers))
+    predictions = predict(models, head, date, time = time, return_proba = True, window = window)
+
+    rest = None
+    if len(tail):
+        def score_rest(head_predictions, head_models):
+            rest_models = dict(iter_models(tail, workers))
+            rest_predictions = predict(rest_models, tail, date, time = time, return_proba = True, window = window)
+            # cache the whole result, as search() would have
+            all_models = {**head_models, **rest_models}
+            all_stations = cell_stations[cell_stations.sourceelementkey.isin(all_models)]
+            all_predictions = pd.concat([head_predictions, rest_predictions], axis=1)
+            _store(key, dict(within = within, time = time, window = window, predictions = all_predictions,
+                             stations = all_stations, models = all_models))
+            # only the stations around <location>
+            sids = [ sid for sid in rest_predictions.columns if sid in shown ]
+            return rest_predictions[sids], { sid: rest_models[sid] for sid in sids }
+        rest = _progress_pool.submit(score_rest, predictions.copy(), dict(models))
+        if not shown.difference(head.sourceelementkey):
+            rest = None # nothing to wait for at <location>, the cell is still cached when done
+
+    # drop the first stations whose model failed to load, as search() does
+    stations = stations[stations.sourceelementkey.isin(models) | ~stations.sourceelementkey.isin(head.sourceelementkey)]
+    if len(stations) == 0:
+        return None,None,None,None
+    predictions = predictions.reindex(columns = stations.sourceelementkey.values)
+    return predictions, stations.copy(), models, rest
+
+def run_search(location, within, date, time = '8:00', window = None, progressive = False, first = 8,
+               engine = 'model', model_dir = 'models/', extend_within = MAX_RADIUS, rank_window = None):
+    """The search behind the app's go button, see app.run_model
+
+    With <progressive>, see search_progressive(). Otherwise, see
+    search(). If <rank_window>, stations are ranked by availability
+    within +/- <rank_window> minutes of <time>, see rank_results().
+    With <progressive>, that is only the stations scored so far; the
+    others follow in order of distance. In both cases the full day at
+    <extend_within> miles is then scored in the background, see
+    extend_search()
+
+    returns (predictions, stations, models, rest), <rest> being None
+    unless <progressive>
+    """
+    rest = None
+    if progressive:
+        predictions, stations, models, rest = search_progressive(location, within, date, time, window, first,
+                                                                 engine = engine, model_dir = model_dir)
+    else:
+        predictions, stations, models = search(location, within, date, time, window, engine = engine, model_dir = model_dir)
+    extend_search(location, date, within = extend_within, engine = engine, model_dir = model_dir)
+    if models is None:
+        return None,None,None,None
+    if rank_window:
+        predictions, stations = rank_results(predictions, stations, time, rank_window)
+    return predictions, stations, models, rest
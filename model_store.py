@@ -0,0 +1,103 @@
+# Model store shared by server processes on the same host
+#
+# One loader process decompresses the empirical tables, station catalog
+# and weather climatology into a store directory, preferably on tmpfs
+# (/dev/shm). Everything is dumped uncompressed, so that the server
+# processes can load it with joblib's mmap_mode='r': numpy arrays are
+# then memory-mapped read-only, and their pages are shared across
+# processes by the OS instead of copied into each of them.
+#
+# NB: the pickled models are NOT stored. sklearn's trees copy their
+# node arrays into each process when unpickled, so an uncompressed copy
+# in tmpfs (several times their size on disk) would only add to the
+# memory of each host. Servers load them from the model directory.
+#
+# Build with
+#   python model_store.py --store /dev/shm/seapark
+# and start the servers with SEAPARK_STORE=/dev/shm/seapark
+import argparse
+import json
+import os
+import sys
+from time import time
+
+DEFAULT_STORE = '/dev/shm/seapark'
+MANIFEST = 'manifest.json' # written last, marks the store as ready
+
+def store_empirical_dir(store):
+    """ directory of the empirical tables inside <store> """
+    return os.path.join(store, 'empirical')
+
+def ready(store):
+    """ if <store> has been fully built """
+    return os.path.exists(os.path.join(store, MANIFEST))
+
+def manifest(store):
+    with open(os.path.join(store, MANIFEST)) as f:
+        return json.load(f)
+
+def load(path):
+    """ load an object from the store, memory-mapping its arrays """
+    import joblib
+    return joblib.load(path, mmap_mode='r')
+
+def load_catalog(store):
+    return load(os.path.join(store, 'catalog.joblib'))
+
+def load_climatology(store, wwin):
+    """ weather climatology for <wwin>, or None if not in the store """
+    path = os.path.join(store, f'climatology_{wwin}.joblib')
+    return load(path) if os.path.exists(path) else None
+
+def _dump(obj, path):
+    import joblib
+    joblib.dump(obj, path + '.tmp', compress=0)
+    os.replace(path + '.tmp', path)
+
+def build_store(store=DEFAULT_STORE, empirical_dir='empirical/', wwins=(10,),
+                coord_fn='data/pay_station_coord.csv', spacetime_fn='data/pay_station_time_limit_space_count.csv'):
+    """Populate <store> from the usual empirical tables and data files.
+    Meant to be run by one process per host; servers attach with
+    SEAPARK_STORE.
+
+    returns the manifest
+    """
+    import model
+    from empirical import EmpiricalTable
+
+    # servers treat the store as not ready while it is being rebuilt
+    if ready(store):
+        os.remove(os.path.join(store, MANIFEST))
+    dst = store_empirical_dir(store)
+    os.makedirs(dst, exist_ok=True)
+
+    _dump(model.get_station_catalog(coord_fn, spacetime_fn), os.path.join(store, 'catalog.joblib'))
+    for wwin in wwins:
+        _dump(model.weather_climatology(wwin), os.path.join(store, f'climatology_{wwin}.joblib'))
+
+    stations = []
+    if os.path.isdir(empirical_dir):
+        for fn in sorted(os.listdir(empirical_dir)):
+            if not fn.endswith('.npz'):
+                continue
+            try:
+                table = EmpiricalTable.load(os.path.join(empirical_dir, fn))
+            except Exception as e:
+                print(f'Failed to load {os.path.join(empirical_dir, fn)}: {e!r}', file=sys.stderr)
+                continue
+            name = fn[:-len('.npz')]
+            _dump(table, os.path.join(dst, f'{name}.joblib'))
+            stations.append(name)
+
+    res = {'created': time(), 'wwins': list(wwins), 'stations': {'empirical': stations}}
+    with open(os.path.join(store, MANIFEST), 'w') as f:
+        json.dump(res, f)
+    return res
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Populate the store shared by server processes')
+    parser.add_argument('--store', default=os.environ.get('SEAPARK_STORE', DEFAULT_STORE))
+    parser.add_argument('--empirical-dir', default='empirical/')
+    args = parser.parse_args()
+    res = build_store(args.store, args.empirical_dir)
+    print(f"Stored the station catalog, weather climatology and {len(res['stations']['empirical'])} empirical tables in {args.store}")
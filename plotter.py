@@ -1,7 +1,5 @@
 # Plot related functions
 # Time-stamp: <2022-05-17 18:35:29 zshuang>
-import seaborn as sns
-from matplotlib import pyplot as plt
 from io import BytesIO
 from mapper import STATION_PALETTE
 import pandas as pd
@@ -37,6 +35,10 @@ def plot_predictions(predictions, figsize, page=1, perpage=10, label_palette=STA
     hrule: if provided, plot a red horizontal line at the given time
 
     """
+    # plotting libraries are slow to import, and are not needed until
+    # there is something to plot
+    import seaborn as sns
+    from matplotlib.figure import Figure
     
     nstations = len(predictions.columns)
     
@@ -47,7 +49,9 @@ def plot_predictions(predictions, figsize, page=1, perpage=10, label_palette=STA
     
     # https://seaborn.pydata.org/tutorial/color_palettes.html
     # color_palette for labels
-    cmap_labels = sns.color_palette(label_palette, n_colors=nstations)
+    # one color per label, as in mapper.add_stations. Labels are 1, 2,
+    # ..., but some may have been dropped since
+    cmap_labels = sns.color_palette(label_palette, n_colors=int(max(predictions.columns)))
     
 
     if nstations > perpage:
@@ -61,8 +65,11 @@ def plot_predictions(predictions, figsize, page=1, perpage=10, label_palette=STA
     
     #figsize = (col_width * height * min(nstations, perpage), height)
 
-    fig = plt.figure(figsize=figsize, dpi=100, constrained_layout=True)
-    ax = sns.heatmap(predictions, cmap=cmap_proba,
+    # NB: a bare Figure rather than pyplot's, which keeps every figure
+    # alive in a global registry that is shared by all sessions'
+    # threads
+    fig = Figure(figsize=figsize, dpi=100, constrained_layout=True)
+    ax = sns.heatmap(predictions, ax=fig.subplots(), cmap=cmap_proba,
                      linewidth=0.004, linecolor='white',
                      cbar=None, 
                      vmin=0, vmax=1,
@@ -73,8 +80,10 @@ def plot_predictions(predictions, figsize, page=1, perpage=10, label_palette=STA
     ax.ylabel=False
     
     # sample code for setting x label background color
-    for i,tl in enumerate(ax.get_xticklabels()):
-        tl.set_backgroundcolor(cmap_labels[i+(page-1)*perpage])
+    # by label, as the markers of mapper.add_stations, since stations
+    # may be listed in any order
+    for label,tl in zip(predictions.columns, ax.get_xticklabels()):
+        tl.set_backgroundcolor(cmap_labels[int(label)-1])
         tl.set_color('white')
         tl.set_fontsize(16)
 
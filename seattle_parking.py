@@ -18,9 +18,46 @@ station_astype = {
     'parkingspacecount': int
 }
 
-def read_noaa_weather_data(fn='data/weather/seattle_weather.csv.gz'):
+# Compact representation, see the <compact> argument of the readers
+# below. Counts fit comfortably in int16, station keys (up to ~140k)
+# need int32
+station_astype_compact = {
+    'occupancydatetime': 'datetime64',
+    'paidoccupancy': 'int16',
+    'parkingspacecount': 'int16'
+}
+key_dtype = 'int32'
+count_dtype = 'int16'
+coord_dtype = 'float32'
+
+def compact_dtypes(df, astype=None):
+    """Return a copy of <df> in a compact representation.
+
+    Columns in the dict <astype> are cast as specified. Of the rest,
+    int64 columns become int32 (if in range), float64 become float32,
+    and object columns with repetitive values become category
+
+    """
+    astype = dict(astype or {})
+    i32 = np.iinfo(np.int32)
+    for c, t in df.dtypes.items():
+        if c in astype:
+            continue
+        if t == np.int64:
+            if len(df) == 0 or (df[c].min() >= i32.min and df[c].max() <= i32.max):
+                astype[c] = 'int32'
+        elif t == np.float64:
+            astype[c] = 'float32'
+        elif t == object:
+            if df[c].nunique() < len(df) / 2:
+                astype[c] = 'category'
+    return df.astype(astype)
+
+def read_noaa_weather_data(fn='data/weather/seattle_weather.csv.gz', compact=False):
     """ Prepare weather information from csv file.
 
+    compact: if True, use float32 instead of float64
+
     Will NOT check if file exists
     """
     df = pd.read_csv(fn, low_memory=False).astype({'DATE':'datetime64'})
@@ -28,22 +65,32 @@ def read_noaa_weather_data(fn='data/weather/seattle_weather.csv.gz'):
 
     # aggregate by date
     daily = df.groupby('DATE')[['TMAX', 'TMIN', 'PRCP', 'SNOW', 'SNWD']].agg('median')
+    if compact:
+        daily = daily.astype(coord_dtype)
     return daily
 
-def read_parking_data(fn='data/station_data/2012/11133.csv.gz'):
+def read_parking_data(fn='data/station_data/2012/11133.csv.gz', compact=False):
     """ Read station data from csv file. 
 
+    compact: if True, hold counts as int16, other numbers as
+    int32/float32 and repetitive strings as category, see compact_dtypes
+
     Will NOT check if file exists """
-    df = pd.read_csv(fn, low_memory=False).astype(station_astype).sort_values('occupancydatetime')
+    if compact:
+        df = compact_dtypes(pd.read_csv(fn, low_memory=False), station_astype_compact).sort_values('occupancydatetime')
+    else:
+        df = pd.read_csv(fn, low_memory=False).astype(station_astype).sort_values('occupancydatetime')
     return df        
 
-def read_parking_data_multiyear(station, years, dir):
+def read_parking_data_multiyear(station, years, dir, compact=False):
     """ Read multiple years data for <station>
 
     years: iterable
 
     dir: base directory for data. Full station data files dir/year/station.csv.gz
 
+    compact: see read_parking_data
+
     Returns None if no data file found
     """
 
@@ -58,20 +105,31 @@ def read_parking_data_multiyear(station, years, dir):
 
     files = filter(check_path, files)
 
-    dfs = [ read_parking_data(fn) for fn in files ]
+    dfs = [ read_parking_data(fn, compact) for fn in files ]
     if dfs:
-        return pd.concat(dfs)
+        res = pd.concat(dfs)
+        if compact:
+            # categories differing across years are concatenated as object
+            res = compact_dtypes(res, station_astype_compact)
+        return res
     else:
         print(f'No available data for station {station}', file=sys.stderr)
         return None
 
+def parse_years(spec):
+    """ '2012-2017' or '2012,2014' => list of years """
+    if '-' in spec:
+        y0, y1 = spec.split('-')
+        return list(range(int(y0), int(y1)+1))
+    return [ int(y) for y in spec.split(',') ]
+
 def merge_station_weather(station,weather):
     """ merge weather data into station data """
 
     station_date = station.occupancydatetime.dt.date.astype('datetime64')
     return station.merge(weather, how='left', left_on = station_date, right_index=True)
 
-def resample_parking_data(df, freq='5min', method='min'):
+def resample_parking_data(df, freq='5min', method='min', compact=False):
     """Resample the time axis of a station dataframe
 
     freq: frequency of resampling for the column <occupancydatetime>
@@ -80,6 +138,9 @@ def resample_parking_data(df, freq='5min', method='min'):
     choice is 'min' since we only care about if a spot has /ever/ been
     available during that time window. 
 
+    compact: if True, counts are int16 (instead of float64 because
+    of the NaN in empty time windows)
+
     Returns a DataFrame that has the same structure as if returned from <read_parking_data>
     """
 
@@ -89,6 +150,8 @@ def resample_parking_data(df, freq='5min', method='min'):
         'parkingspacecount': 'max' # Just need a number. It should be a constant over the 5min
         }).reset_index().dropna()
     res.columns = ['occupancydatetime', 'paidoccupancy', 'parkingspacecount']
+    if compact:
+        res = res.astype({'paidoccupancy': count_dtype, 'parkingspacecount': count_dtype})
     return res
 
 
@@ -107,18 +170,29 @@ def uniquefy_station_coord(fin='data/Pay_Stations.csv', fout='data/pay_station_c
     df.groupby('ELMNTKEY').apply(lambda x: x.iloc[0])[['ELMNTKEY','SHAPE_LAT','SHAPE_LNG']].to_csv(fout, index=False)
     return None
 
-def read_station_coord(fn='data/pay_station_coord.csv'):
+def read_station_coord(fn='data/pay_station_coord.csv', compact=False):
     """ Return a dataframe with columns ['sourceelementkey', 'lat',
-    'long'] specifying coordinate of each station """
+    'long'] specifying coordinate of each station
+
+    compact: if True, keys are int32 and coordinates float32 (about
+    a meter of precision in Seattle)
+    """
     
     res = pd.read_csv(fn)[['ELMNTKEY', 'SHAPE_LAT', 'SHAPE_LNG']]
     res.columns = ['sourceelementkey', 'latitude', 'longitude']
+    if compact:
+        res = res.astype({'sourceelementkey': key_dtype, 'latitude': coord_dtype, 'longitude': coord_dtype})
     return res
 
-def read_station_space_time(fn='data/pay_station_time_limit_space_count.csv'):
+def read_station_space_time(fn='data/pay_station_time_limit_space_count.csv', compact=False):
     """Return a dataframe with columns ['sourceelementkey',
-    'time_limit_min', 'time_limit_max', 'space_count']"""
+    'time_limit_min', 'time_limit_max', 'space_count']
+
+    compact: if True, keys are int32 and the rest int16
+    """
     res = pd.read_csv(fn).astype(int)
+    if compact:
+        res = res.astype({c: key_dtype if c == 'elmntkey' else count_dtype for c in res.columns})
     return res
 
 def latlng_dist(locations, ref=None, r=3963):
@@ -132,9 +206,11 @@ def latlng_dist(locations, ref=None, r=3963):
 
     """
 
-    lat,lng = (np.asarray(locations) / 180 * np.pi).T
+    # NB: always compute in float64. arccos of float32 is far too
+    # coarse near 0 for distances of a few blocks
+    lat,lng = (np.asarray(locations, dtype=np.float64) / 180 * np.pi).T
     if ref:
-        lat0, lng0 = np.asarray(ref) / 180 * np.pi
+        lat0, lng0 = np.asarray(ref, dtype=np.float64) / 180 * np.pi
     else:
         lat0, lng0 = lat[0], lng[0]
 
@@ -143,19 +219,32 @@ def latlng_dist(locations, ref=None, r=3963):
 
     return angles * r
 
-def find_nearby_stations(location=SPACE_NEEDLE, within=0.3, coord_fn='data/pay_station_coord.csv', spacetime_fn='data/pay_station_time_limit_space_count.csv', no_duplicate=True):
-    """ find parking stations within <within> miles of <location> """
-    df = read_station_coord(coord_fn)
-    df_st = read_station_space_time(spacetime_fn)
-    df = pd.merge(left=df, right=df_st, left_on='sourceelementkey', right_on='elmntkey').drop('elmntkey', axis=1)
+def read_station_catalog(coord_fn='data/pay_station_coord.csv', spacetime_fn='data/pay_station_time_limit_space_count.csv', compact=False):
+    """Return a dataframe with coordinate, time limit and space count of
+    every station, i.e., columns ['sourceelementkey', 'latitude',
+    'longitude', 'time_limit_min', 'time_limit_max', 'space_count']
+
+    compact: see read_station_coord and read_station_space_time
+    """
+    df = read_station_coord(coord_fn, compact)
+    df_st = read_station_space_time(spacetime_fn, compact)
+    return pd.merge(left=df, right=df_st, left_on='sourceelementkey', right_on='elmntkey').drop('elmntkey', axis=1)
+
+def find_nearby_stations(location=SPACE_NEEDLE, within=0.3, coord_fn='data/pay_station_coord.csv', spacetime_fn='data/pay_station_time_limit_space_count.csv', no_duplicate=True, catalog=None):
+    """ find parking stations within <within> miles of <location>
+
+    catalog: if provided, a dataframe as returned by
+    read_station_catalog, in which case <coord_fn> and <spacetime_fn>
+    are not read. It is left unchanged.
+    """
+    df = read_station_catalog(coord_fn, spacetime_fn) if catalog is None else catalog
     dist = latlng_dist(df[['latitude', 'longitude']], location)
-    df['dist'] = dist
+    df = df.assign(dist=dist)
     return df.iloc[dist <= within].sort_values('dist')
 
 
 ################################################################
 # Learning
-from sklearn.preprocessing import FunctionTransformer
 def trig(func, period, as_transformer=False):
     """ currying a trignometric function with custom period
 
@@ -168,99 +257,21 @@ def trig(func, period, as_transformer=False):
 
     f = partial(_trig, func=func, period=period)
     if as_transformer:
+        from sklearn.preprocessing import FunctionTransformer
         f = FunctionTransformer(f)
     return f
 
-from sklearn.base import BaseEstimator, TransformerMixin
-class TimeSplitter(BaseEstimator, TransformerMixin):
-    """Split timestamps into separate columns of ['mon', 'day', 'dow',
-    'doy', 'hr', 'min']. If include_year=True, also include 'yr' in
-    the result.
-
-    This is to be used as part of a ColumnTransformer
-
-    """
-    def __init__(self, include_year=False):
-        self.include_year = include_year
+# The sklearn transformers live in learning.py, so that this module
+# can be imported without sklearn. Pickled models still look them up
+# here, hence the lazy module attribute.
+_LEARNING_NAMES = ('TimeSplitter', 'TrigTransformer')
+def __getattr__(name):
+    if name in _LEARNING_NAMES:
+        import learning
+        return getattr(learning, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-    def fit(self,X=None,y=None):
-        return self
-    
-    def transform(self,X):
-        """ this assumes X is a series of timestamps """
-        X = X.astype('datetime64')
-        dt = X.dt
-        res = {}
-        if self.include_year:
-            res = {'yr': dt.year}
-        res.update({
-            'mon': dt.month,
-            'day': dt.day,
-            'dow': dt.day_of_week,
-            'doy': dt.day_of_year,
-            'hr': dt.hour,
-            'min': dt.minute,
-        })
-        
-        return pd.DataFrame(res).reset_index(drop=True)
-
-class TrigTransformer(BaseEstimator, TransformerMixin):
-    """Apply trignometric functions to selected columns with customizable
-    period and harmonics """
-
-    def __init__(self, concat=True, h=[1,2], plan=None):
-        """Apply trignometric transformation.
-
-        h: harmonics to apply
-
-        concat: if True, return concat of raw input and the trig
-        transformations. Otherwise, just return the trig
-        transformations
-
-        plan should be a dict where each key value pair has the form
-        column: (period, [harmonics]), e.g., 'mon': (12,[1,2,3]),
-        where `mon' is the name of a column in the data to be
-        transformed. Harmonics specified in kwargs will override the
-        `global' <h>
-        
-        default: apply to dow (day_of_week), doy (day_of_year), hr, min, with harmonics [1,2]
-
-        """
-        # NB: MUST save input variables AND under the same name,
-        # otherwise will cause error if put inside a ColumnTransformer.
-        self.concat = concat
-        self.h = h
-
-        self.plan = plan
-
-    def fit(self, X=None, y=None):
-        return self
-
-    def transform(self, X):
-        # default if plan is None
-        plan = self.plan or {
-            'doy': (365.25, h),
-            'dow': (5, h), # only work days, so period = 5
-            'hr': (10,h), # only 8 am to 17:55 pm
-            'min': (60,h)
-        }
-
-        
-        data = []
-        label = []
-
-        for column, (period, harmonics) in self.plan.items():
-            for f in (np.sin, np.cos):
-                for h in harmonics:
-                    label.append(f'{f.__name__}_{column}_{h}')
-                    func = trig(f, period/h)
-                    data.append(func(X[column]))
-        trig_data = pd.DataFrame(np.asarray(data).T, columns = label)
-        if self.concat:
-            return pd.concat([X,trig_data], axis=1)
-        return trig_data
 
-
 ################################################################
 # For older notebooks. Consider remove in future
 read_station_data = read_parking_data
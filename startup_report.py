@@ -0,0 +1,63 @@
+# Report on the cost of the app's startup path
+#
+# Usage: python startup_report.py [--prewarm]
+#
+# Each module is imported in a fresh interpreter, so that the times do
+# not depend on what has been imported before. Also reports which of
+# the heavy dependencies got pulled in as a side effect.
+import argparse
+import json
+import subprocess
+import sys
+
+# Modules on the startup path of app.py, in import order
+MODULES = ['pandas', 'streamlit', 'streamlit_folium', 'folium',
+           'seattle_parking', 'model', 'mapper', 'plotter']
+
+# Dependencies that should only be loaded when needed
+HEAVY = ['sklearn', 'joblib', 'seaborn', 'matplotlib']
+
+_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+t = time.perf_counter() - t0
+print(json.dumps({{'seconds': t, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def time_import(module):
+    """ import <module> in a fresh interpreter
+
+    returns dict(seconds=..., loaded=[heavy modules imported along the way]),
+    or None if the import failed
+    """
+    code = _PROBE.format(module=module, heavy=HEAVY)
+    res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    if res.returncode != 0:
+        print(f'Failed to import {module}:\n{res.stderr}', file=sys.stderr)
+        return None
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+def report(modules=MODULES, prewarm=False):
+    print('%-20s %10s   %s'%('module', 'import (s)', 'heavy deps loaded'))
+    for m in modules:
+        r = time_import(m)
+        if r is None:
+            print('%-20s %10s'%(m, 'failed'))
+            continue
+        print('%-20s %10.3f   %s'%(m, r['seconds'], ', '.join(r['loaded']) or '-'))
+
+    if prewarm:
+        import model
+        from appstate import MODEL_DIR, MODEL_ENGINE
+        print()
+        print('%-20s %10s'%('prewarm step', 'time (s)'))
+        for step, t in model.prewarm(model_dir=MODEL_DIR, engine=MODEL_ENGINE).items():
+            print('%-20s %10.3f'%(step, t))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report import and pre-warm costs of the app')
+    parser.add_argument('--prewarm', action='store_true', help='also time model.prewarm()')
+    parser.add_argument('modules', nargs='*', default=MODULES, help='modules to time')
+    args = parser.parse_args()
+    report(args.modules, args.prewarm)